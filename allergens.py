@@ -0,0 +1,130 @@
+"""Словарь аллергенов и битовые маски для сопоставления блюд и учеников.
+
+Аллергены блюда (MenuItem.allergens) и аллергии ученика (User.allergies) вводятся свободным
+текстом. При записи текст разбирается по словарю ALLERGENS и сохраняется как битовая маска
+(MenuItem.allergen_mask, User.allergy_mask): блюдо опасно для ученика, если
+``allergen_mask & allergy_mask != 0``. Проверка всего меню для всех учеников - одно побитовое
+И над массивами NumPy (см. ``conflict_matrix``).
+
+Номер бита - позиция аллергена в ALLERGENS, маски хранятся в базе. Новые аллергены добавляются
+только в конец списка, существующие не переставляются и не удаляются.
+"""
+import re
+
+import numpy as np
+
+# (название, основы слов-синонимов): слово текста совпадает, если начинается с одной из основ.
+# Короткие основы (до SHORT_STEM_LENGTH букв) совпадают только с падежным окончанием:
+# "мед" находит "меда" и "медом", но не "медведь" и "медицина"
+ALLERGENS = [
+    ('молоко', ('молок', 'молоч', 'лактоз', 'сливк', 'сливоч', 'сыр', 'сырн', 'сырк', 'сырок', 'творог', 'творож',
+                'кефир', 'йогурт', 'сметан', 'казеин')),
+    ('яйца', ('яйц', 'яиц', 'яичн', 'яйко', 'белок', 'желток', 'омлет', 'майонез')),
+    ('глютен', ('глютен', 'клейковин', 'пшени', 'мук', 'мучн', 'рожь', 'ржи', 'ржан', 'ячмен', 'овес', 'овс', 'овсян',
+                'манн', 'хлеб', 'макарон')),
+    ('орехи', ('орех', 'фундук', 'миндал', 'кешью', 'фисташ', 'пекан', 'кедров')),
+    ('арахис', ('арахис',)),
+    ('соя', ('соя', 'сои', 'сою', 'соев')),
+    ('рыба', ('рыб', 'рыбн', 'лосос', 'треск', 'минтай', 'хек', 'тунец', 'тунц', 'сельдь', 'сельди', 'селедк',
+              'скумбри', 'горбуш', 'семг')),
+    ('ракообразные', ('ракообраз', 'краб', 'кревет', 'рак', 'омар', 'лангуст')),
+    ('моллюски', ('моллюск', 'мидии', 'мидия', 'кальмар', 'устриц', 'осьмин')),
+    ('сельдерей', ('сельдере',)),
+    ('горчица', ('горчиц', 'горчичн')),
+    ('кунжут', ('кунжут', 'сезам')),
+    ('сульфиты', ('сульфит', 'диоксид серы')),
+    ('люпин', ('люпин',)),
+    ('мед', ('мед', 'медов')),
+    ('цитрусовые', ('цитрус', 'апельсин', 'лимон', 'мандарин', 'грейпфрут')),
+    ('какао', ('какао', 'шоколад')),
+]
+NAMES = [name for name, _ in ALLERGENS]
+SHORT_STEM_LENGTH = 3
+# Падежные окончания, с которыми совпадают короткие основы
+SHORT_STEM_ENDINGS = {'', 'а', 'я', 'у', 'ю', 'ы', 'и', 'е', 'о', 'ом', 'ем', 'ой', 'ей', 'ов', 'ев', 'ам', 'ами', 'ах'}
+# Слова, которые совпадают с основой, но аллергеном не являются
+EXCLUDED_WORDS = {'медь', 'медленно', 'медицинский', 'раковина', 'ракета', 'сырой', 'сырая', 'сырое', 'сырые'}
+# Отрицание исключает аллергены до конца фрагмента: "без глютена и лактозы", "не содержит орехов"
+NEGATIONS = {'без', 'не', 'нет'}
+# Служебные слова в перечислениях: "аллергия на орехи и мед"
+STOP_WORDS = {'на', 'и', 'или', 'а', 'с', 'со', 'в', 'аллергия', 'аллергии', 'непереносимость'} | NEGATIONS
+
+_SPLIT_RE = re.compile(r'[,;/\n]+')
+_WORD_RE = re.compile(r'[a-zа-я]+')
+_NEGATION_RE = re.compile(r'\b(?:%s)\b' % '|'.join(sorted(NEGATIONS)))
+
+
+def _normalize(text):
+    return (text or '').lower().replace('ё', 'е')
+
+
+# Основы по битам: отдельные слова и словосочетания проверяются по-разному
+_WORD_STEMS = [tuple(_normalize(s) for s in stems if ' ' not in s) for _, stems in ALLERGENS]
+_PHRASE_STEMS = [tuple(_normalize(s) for s in stems if ' ' in s) for _, stems in ALLERGENS]
+
+
+def _stem_matches(word, stem):
+    if not word.startswith(stem):
+        return False
+    return len(stem) > SHORT_STEM_LENGTH or word[len(stem):] in SHORT_STEM_ENDINGS
+
+
+def _word_mask(word):
+    if word in EXCLUDED_WORDS:
+        return 0
+    mask = 0
+    for bit, stems in enumerate(_WORD_STEMS):
+        if any(_stem_matches(word, stem) for stem in stems):
+            mask |= 1 << bit
+    return mask
+
+
+def _fragment_mask(fragment):
+    mask = 0
+    for bit, stems in enumerate(_PHRASE_STEMS):
+        if any(stem in fragment for stem in stems):
+            mask |= 1 << bit
+    words = [w for w in _WORD_RE.findall(fragment) if w not in STOP_WORDS]
+    for word in words:
+        mask |= _word_mask(word)
+    return mask, bool(words)
+
+
+def parse(text):
+    """Разбирает свободный текст: (маска, [нераспознанные фрагменты]).
+
+    Аллергены после отрицания ("без глютена") в маску не попадают, но и нераспознанными не считаются.
+    """
+    mask = 0
+    unknown = []
+    for part in _SPLIT_RE.split(_normalize(text)):
+        negation = _NEGATION_RE.search(part)
+        cut = negation.start() if negation else len(part)
+        part_mask, has_words = _fragment_mask(part[:cut])
+        negated_mask, has_negated_words = _fragment_mask(part[cut:])
+        if (has_words or has_negated_words) and not (part_mask or negated_mask):
+            unknown.append(part.strip())
+        mask |= part_mask
+    return mask, unknown
+
+
+def to_mask(text):
+    return parse(text)[0]
+
+
+def names(mask):
+    """Названия аллергенов маски по порядку словаря."""
+    return [name for bit, name in enumerate(NAMES) if mask >> bit & 1]
+
+
+def conflict_matrix(user_masks, dish_masks):
+    """Матрица (ученики x блюда): True, если блюдо содержит аллерген ученика."""
+    users = np.asarray(user_masks, dtype=np.int64)
+    dishes = np.asarray(dish_masks, dtype=np.int64)
+    return (users[:, None] & dishes[None, :]) != 0
+
+
+def allergen_counts(masks):
+    """Сколько масок содержит каждый аллерген словаря: {название: число}."""
+    masks = np.asarray(masks, dtype=np.int64)
+    return {name: int(np.count_nonzero(masks >> bit & 1)) for bit, name in enumerate(NAMES)}
@@ -1,20 +1,132 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, make_response
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, make_response, stream_with_context, get_template_attribute
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
-from datetime import datetime, timedelta, date
-from sqlalchemy import func
+from datetime import datetime, timedelta, date, timezone
+from sqlalchemy import func, inspect, event
 import csv
 import io
+import base64
+import binascii
+import zlib
+import json
+import bisect
+import queue
+import threading
+import atexit
+import time
+from types import SimpleNamespace
+import click
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import forecast
+import allergens
+import instrumentation
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret-key-olimpiada-123' # В реальном проекте скрыть
 # Настройка базы данных
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///canteen.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Уведомления пишутся фоновым потоком пачками (0 - синхронно, в момент вызова)
+app.config['NOTIFICATIONS_ASYNC'] = os.environ.get('NOTIFICATIONS_ASYNC', '1') != '0'
+# Хэширование паролей: метод/стоимость и размер пула потоков для проверки (0 - в потоке запроса)
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', '0'))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', '10'))
+# Сколько секунд опросные API (заказы, уведомления, меню) доверяют кэшированному пользователю
+app.config['USER_CACHE_SECONDS'] = float(os.environ.get('USER_CACHE_SECONDS', '30'))
+# Как часто (сек.) кэш меню сверяет версию с базой и перечитывает остатки
+app.config['MENU_CACHE_SECONDS'] = float(os.environ.get('MENU_CACHE_SECONDS', '2'))
+# Сколько секунд меню показывает закэшированные последние отзывы
+app.config['MENU_REVIEWS_CACHE_SECONDS'] = float(os.environ.get('MENU_REVIEWS_CACHE_SECONDS', '60'))
+# Инструментирование: порог медленного запроса, заголовок Server-Timing, выборочный профайлер (0 - выключен)
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+app.config['SERVER_TIMING_HEADER'] = os.environ.get('SERVER_TIMING_HEADER', '0') == '1'
+app.config['PROFILER_INTERVAL_MS'] = float(os.environ.get('PROFILER_INTERVAL_MS', '0'))
+# Если задан, /metrics отдается только с заголовком Authorization: Bearer <токен>; иначе - только администратору
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# --- НАСТРОЙКИ ХРАНЕНИЯ ИСТОРИИ ---
+# Выполненные заказы старше N дней уходят в архив, прочитанные уведомления
+# и рассылки старше N дней удаляются. Интервал фоновой архивации в часах (0 - только командой archive-history)
+app.config['ORDER_RETENTION_DAYS'] = int(os.environ.get('ORDER_RETENTION_DAYS', '180'))
+app.config['NOTIFICATION_RETENTION_DAYS'] = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', '30'))
+app.config['ARCHIVE_BATCH_SIZE'] = int(os.environ.get('ARCHIVE_BATCH_SIZE', '1000'))
+app.config['ARCHIVE_INTERVAL_HOURS'] = float(os.environ.get('ARCHIVE_INTERVAL_HOURS', '0'))
+
+# --- НАСТРОЙКИ ПЕРЕМЕН ВЫДАЧИ ---
+# Перемены выдачи "начало-конец" через запятую (местное время), емкость перемены в порциях
+# и на сколько дней вперед можно сделать предзаказ. Отметки времени в базе хранятся в UTC (datetime.utcnow);
+# в местное время они переводятся только для дня и перемены: сводка продаж по дням, "сегодня", перемены
+app.config['SERVING_SLOTS'] = os.environ.get('SERVING_SLOTS', '09:40-10:00,11:40-12:00,13:30-13:50')
+app.config['SLOT_CAPACITY'] = int(os.environ.get('SLOT_CAPACITY', '300'))
+app.config['PREORDER_DAYS'] = int(os.environ.get('PREORDER_DAYS', '7'))
+
+# --- ПРОФИЛИ ДВИЖКА БД ---
+# Адрес базы берется из DATABASE_URL (по умолчанию - локальный SQLite), профиль - из DB_PROFILE
+# или по типу базы. Для SQLite профиль 'sqlite-wal' включает WAL: читатели дашбордов не блокируются
+# записью в buy/complete_order, а busy_timeout заставляет писателей ждать вместо "database is locked".
+DB_PROFILES = {
+    'sqlite-default': {'pragmas': {}},
+    'sqlite-wal': {
+        'pragmas': {
+            'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+            'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '10000')),
+            'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', '20000')), # Отрицательное значение - в КБ
+            'temp_store': 'MEMORY',
+        },
+    },
+    'postgresql': {
+        'options': {'pool_pre_ping': True, 'pool_recycle': 1800},
+    },
+}
+
+def database_url():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///canteen.db')
+    # Render/Heroku отдают адрес со схемой postgres://, SQLAlchemy ожидает postgresql://
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def database_profile(url):
+    default = 'sqlite-wal' if url.startswith('sqlite') else 'postgresql'
+    return os.environ.get('DB_PROFILE', default)
+
+def engine_options(url, profile):
+    options = dict(DB_PROFILES[profile].get('options', {}))
+    in_memory = url in ('sqlite://', 'sqlite:///:memory:')
+    if not in_memory:
+        # Пул на число потоков worker'а (--threads gunicorn), с запасом на фоновые потоки
+        options['pool_size'] = int(os.environ.get('DB_POOL_SIZE', '32'))
+        options['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', '8'))
+        options['pool_timeout'] = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
+    if url.startswith('sqlite'):
+        options['connect_args'] = {'check_same_thread': False,
+                                   'timeout': DB_PROFILES[profile].get('pragmas', {}).get('busy_timeout', 5000) / 1000}
+    return options
+
+def apply_sqlite_pragmas(dbapi_connection, profile):
+    pragmas = DB_PROFILES[profile].get('pragmas', {})
+    if not pragmas:
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['DB_PROFILE'] = database_profile(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config['DB_PROFILE'])
 
 db = SQLAlchemy(app)
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        @event.listens_for(db.engine, 'connect')
+        def _on_sqlite_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, app.config['DB_PROFILE'])
+request_metrics, stack_sampler = instrumentation.init_app(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -27,8 +139,11 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), nullable=False) # 'student', 'cook', 'admin'
     allergies = db.Column(db.String(200), default="") # Для учеников
+    allergy_mask = db.Column(db.Integer, nullable=False, default=0) # Аллергии по словарю allergens.py (битовая маска)
     subscription_end = db.Column(db.DateTime, nullable=True) # Дата окончания абонемента
     balance = db.Column(db.Float, default=0.0) # Баланс пользователя
+    broadcast_read_id = db.Column(db.Integer, nullable=False, default=0) # Последняя прочитанная рассылка для роли
+    notif_version = db.Column(db.Integer, nullable=False, default=0) # Растет при каждом изменении личных уведомлений
 
 class MenuItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -38,8 +153,13 @@ class MenuItem(db.Model):
     quantity = db.Column(db.Integer, default=0) # Остатки продуктов
     date = db.Column(db.Date, default=date.today) # Дата актуальности
     allergens = db.Column(db.String(200), default="") # Аллергены
+    allergen_mask = db.Column(db.Integer, nullable=False, default=0) # Аллергены по словарю allergens.py (битовая маска)
     is_active = db.Column(db.Boolean, default=False) # Статус публикации (False = Черновик, True = В меню)
 
+    __table_args__ = (
+        db.Index('uq_menu_item_name_category', 'name', 'category', unique=True), # Upsert в add_dish
+    )
+
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -51,6 +171,23 @@ class Review(db.Model):
     user = db.relationship('User', backref='reviews')
     item = db.relationship('MenuItem', backref='reviews')
 
+    __table_args__ = (
+        db.Index('ix_review_timestamp_id', 'timestamp', 'id'), # Лента отзывов: новые / старые
+        db.Index('ix_review_rating_id', 'rating', 'id'), # Лента отзывов: по рейтингу
+        db.Index('ix_review_item_id', 'item_id', 'id'), # Последние отзывы на блюдо, сводка по блюдам
+    )
+
+class RecipeIngredient(db.Model):
+    # Техкарта: сколько единиц продукта со склада уходит на одну порцию блюда
+    id = db.Column(db.Integer, primary_key=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False) # В единицах остатка продукта
+
+    __table_args__ = (
+        db.UniqueConstraint('dish_id', 'product_id', name='uq_recipe_dish_product'),
+    )
+
 class SupplyRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_name = db.Column(db.String(100), nullable=False)
@@ -60,6 +197,11 @@ class SupplyRequest(db.Model):
     total_cost = db.Column(db.Float, default=0.0) # Стоимость закупки
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_supply_request_status_created', 'status', 'created_at'),
+        db.Index('ix_supply_request_created_id', 'created_at', 'id'), # История заявок повара по страницам
+    )
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -67,40 +209,1620 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_notification_user_read_created', 'user_id', 'is_read', 'created_at'),
+    )
+
+class BroadcastMessage(db.Model):
+    # Рассылка на всю роль хранится одной строкой; прочитанность - через User.broadcast_read_id
+    id = db.Column(db.Integer, primary_key=True)
+    role = db.Column(db.String(20), nullable=False)
+    message = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_broadcast_message_role_id', 'role', 'id'),
+    )
+
+# Состояние заказа в очереди кухни (отдельно от способа оплаты в status)
+ORDER_OPEN = 'open'
+ORDER_COMPLETED = 'completed'
+
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'))
-    status = db.Column(db.String(50), default="Paid") # 'Paid (One-time)', 'Paid (Subscription)'
+    status = db.Column(db.String(50), default="Paid") # 'Issued', 'Issued (Sub)', 'Paid (Subscription)'
+    quantity = db.Column(db.Integer, nullable=False, default=1) # Количество порций в заказе
+    unit_price = db.Column(db.Float, nullable=True) # Цена порции на момент покупки
+    issued = db.Column(db.Integer, nullable=False, default=0) # Сколько порций уже выдано
+    state = db.Column(db.String(20), nullable=False, default=ORDER_OPEN) # 'open', 'completed'
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    serve_date = db.Column(db.Date, nullable=True) # День выдачи (предзаказ); NULL - старые заказы "на сейчас"
+    slot = db.Column(db.String(5), nullable=True) # Перемена выдачи, 'ЧЧ:ММ' (начало)
     
     user = db.relationship('User', backref='orders')
     item = db.relationship('MenuItem', backref='orders')
 
+    __table_args__ = (
+        db.Index('ix_order_state_timestamp', 'state', 'timestamp'), # Очередь кухни
+        db.Index('ix_order_user_timestamp', 'user_id', 'timestamp'), # "Уже заказано сегодня"
+        db.Index('ix_order_timestamp', 'timestamp'), # Финансовая статистика по периодам
+        db.Index('ix_order_state_slot', 'state', 'serve_date', 'slot'), # Очередь кухни по переменам
+    )
+
+class ServingSlot(db.Model):
+    # Сколько порций забронировано на перемену конкретного дня; строка появляется с первой бронью
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    slot = db.Column(db.String(5), nullable=False) # Начало перемены, 'ЧЧ:ММ'
+    capacity = db.Column(db.Integer, nullable=False)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'slot', name='uq_serving_slot_day_slot'),
+    )
+
+class OrderArchive(db.Model):
+    # Выполненные заказы старше ORDER_RETENTION_DAYS (id сохраняется). Состояние не храним - всегда 'completed'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'))
+    status = db.Column(db.String(50))
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    unit_price = db.Column(db.Float, nullable=True)
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    timestamp = db.Column(db.DateTime)
+    serve_date = db.Column(db.Date, nullable=True)
+    slot = db.Column(db.String(5), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_order_archive_timestamp', 'timestamp'),
+    )
+
+class DailySales(db.Model):
+    # Сводка продаж за день по позиции меню, обновляется в той же транзакции, что и заказ
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
+    portions = db.Column(db.Integer, nullable=False, default=0) # Все порции (включая выданные по абонементу)
+    sub_portions = db.Column(db.Integer, nullable=False, default=0) # Из них по абонементу
+    revenue = db.Column(db.Float, nullable=False, default=0.0) # Фактически оплачено
+    new_students = db.Column(db.Integer, nullable=False, default=0) # Ученики, для которых это первый заказ за день
+
+    __table_args__ = (
+        db.Index('ux_daily_sales_day_item', 'day', 'item_id', unique=True),
+    )
+
+class AppCounter(db.Model):
+    # Общие для всех worker'ов счетчики версий (например, версия меню)
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class OrderEvent(db.Model):
+    # Журнал изменений очереди кухни для SSE: пишется в транзакции изменения, каждый worker читает его
+    # для своих потоков (см. OrderFeed). Хранится ORDER_EVENT_RETENTION секунд
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_order_event_created_at', 'created_at'),
+    )
+
+class SchemaMigration(db.Model):
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- КЭШ ПОЛЬЗОВАТЕЛЕЙ ДЛЯ ОПРОСНЫХ API ---
+# Опросные эндпоинты (очередь кухни, уведомления, остатки меню) вызываются каждые несколько секунд
+# из каждой вкладки, а от пользователя им нужны только id и роль. Для них load_user отдает
+# неизменяемый снимок из памяти вместо запроса к базе. Остальные маршруты (покупки, профиль)
+# всегда получают настоящий объект User из базы и заодно обновляют снимок.
+CACHED_USER_ENDPOINTS = {'get_orders', 'order_stream', 'get_notifications', 'notification_count', 'menu_api'}
+
+class CachedUser(UserMixin):
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.role = user.role
+        self.allergies = user.allergies
+        self.allergy_mask = user.allergy_mask or 0
+        self.subscription_end = user.subscription_end
+        self.balance = user.balance
+
+class UserCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, user):
+        expires_at = time.monotonic() + app.config['USER_CACHE_SECONDS']
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[user.id] = (expires_at, CachedUser(user))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats, size=len(self._entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+user_cache = UserCache()
+
+def invalidate_user(user_id):
+    # Вызывать при изменении баланса, роли, аллергий, пароля пользователя
+    user_cache.invalidate(user_id)
+
 # Связь с Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    if request.endpoint in CACHED_USER_ENDPOINTS and app.config['USER_CACHE_SECONDS'] > 0:
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            return cached
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.put(user)
+    return user
+
+# --- ПАРОЛИ ---
+# Метод хэширования задается PASSWORD_HASH_METHOD (например 'scrypt:16384:8:1' или 'pbkdf2:sha256:600000').
+# При смене метода пароль перехэшируется при следующем успешном входе.
+# scrypt/pbkdf2 отпускают GIL, поэтому проверку можно вынести в ограниченный пул потоков
+# (PASSWORD_HASH_WORKERS): при массовом входе класса одновременно считается не больше N хэшей,
+# остальные ждут в очереди не дольше PASSWORD_HASH_TIMEOUT секунд.
+class PasswordHashBusy(Exception):
+    pass
+
+_password_executor = None
+_password_executor_lock = threading.Lock()
+_hash_prefix_cache = {}
+
+def _password_pool():
+    global _password_executor
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return None
+    if _password_executor is None:
+        with _password_executor_lock:
+            if _password_executor is None:
+                _password_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+    return _password_executor
+
+def _run_hashing(fn, *args):
+    pool = _password_pool()
+    if pool is None:
+        return fn(*args)
+    future = pool.submit(fn, *args)
+    try:
+        return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHashBusy()
+
+def hash_password(password):
+    return _run_hashing(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    return _run_hashing(check_password_hash, password_hash, password)
+
+def password_needs_rehash(password_hash):
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method not in _hash_prefix_cache:
+        # Werkzeug дописывает параметры по умолчанию ('scrypt' -> 'scrypt:32768:8:1')
+        _hash_prefix_cache[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _hash_prefix_cache[method]
+
+# --- СХЕМА БД И МИГРАЦИИ ---
+# db.create_all() создает только отсутствующие таблицы. Для уже существующей canteen.db
+# migrate_schema() дополнительно добавляет новые колонки, выполняет разовые миграции данных
+# и создает недостающие индексы. Запускается при старте и командой `flask migrate-db`.
+MIGRATIONS = []
+
+def migration(name):
+    def decorator(fn):
+        MIGRATIONS.append((name, fn))
+        return fn
+    return decorator
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def add_missing_columns(conn):
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column.type.compile(dialect=conn.dialect)}'
+            default = column.default.arg if column.default is not None and column.default.is_scalar else None
+            if default is not None:
+                ddl += f' DEFAULT {_sql_literal(default)}'
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            conn.exec_driver_sql(ddl)
+
+def create_missing_indexes(conn):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+def migrate_schema():
+    db.create_all()
+    with db.engine.begin() as conn:
+        add_missing_columns(conn)
+        applied = {row[0] for row in conn.execute(db.select(SchemaMigration.name))}
+        for name, fn in MIGRATIONS:
+            if name not in applied:
+                fn(conn)
+                conn.execute(SchemaMigration.__table__.insert().values(name=name, applied_at=datetime.utcnow()))
+        create_missing_indexes(conn)
+
+@migration('0001_order_state')
+def _migrate_order_state(conn):
+    # Раньше выполненный заказ отмечался только статусом 'Completed'
+    conn.execute(Order.__table__.update().where(Order.status == 'Completed').values(state=ORDER_COMPLETED))
+
+# --- СВОДНАЯ ТАБЛИЦА ПРОДАЖ (DailySales) ---
+# Админская статистика и отчеты читают O(дней) строк сводки вместо O(заказов).
+SUBSCRIPTION_STATUS = 'Issued (Sub)'
+
+def _as_date(value):
+    # SQLite возвращает date() строкой, PostgreSQL - объектом date
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+def to_local(ts):
+    # Отметка времени из базы (UTC) -> местное время сервера
+    return ts.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+def day_start(d):
+    # Начало местного дня d в UTC - граница для фильтров по отметкам времени в базе
+    return datetime.combine(d, datetime.min.time()).astimezone(timezone.utc).replace(tzinfo=None)
+
+def local_date(column):
+    # SQL: местная дата отметки времени в UTC (по текущему смещению часового пояса сервера)
+    offset = datetime.now().astimezone().utcoffset()
+    if db.engine.dialect.name == 'postgresql':
+        return func.date(column + offset)
+    return func.date(column, f'{int(offset.total_seconds()):+d} seconds')
+
+def _upsert(table):
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+def record_sale(day, item_id, portions, revenue, sub_portions=0, new_student=False):
+    table = DailySales.__table__
+    stmt = _upsert(table).values(day=day, item_id=item_id, portions=portions, sub_portions=sub_portions,
+                                 revenue=revenue, new_students=1 if new_student else 0)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['day', 'item_id'],
+        set_={
+            'portions': table.c.portions + stmt.excluded.portions,
+            'sub_portions': table.c.sub_portions + stmt.excluded.sub_portions,
+            'revenue': table.c.revenue + stmt.excluded.revenue,
+            'new_students': table.c.new_students + stmt.excluded.new_students,
+        })
+    db.session.execute(stmt)
+
+def is_first_order_today(user_id, now):
+    # Вызывать до добавления новых заказов в сессию
+    today_start = day_start(to_local(now).date())
+    return not db.session.query(Order.query.filter(Order.user_id == user_id, Order.timestamp >= today_start).exists()).scalar()
+
+def order_history(since=None, until=None):
+    # Заказы вместе с архивом одной выборкой - для пересчета сводки и выгрузки
+    live = db.select(Order.id, Order.user_id, Order.item_id, Order.status, Order.quantity, Order.unit_price,
+                     Order.issued, Order.state, Order.timestamp, Order.serve_date, Order.slot)
+    archived = db.select(OrderArchive.id, OrderArchive.user_id, OrderArchive.item_id, OrderArchive.status,
+                         OrderArchive.quantity, OrderArchive.unit_price, OrderArchive.issued,
+                         db.literal(ORDER_COMPLETED).label('state'), OrderArchive.timestamp,
+                         OrderArchive.serve_date, OrderArchive.slot)
+    if since is not None:
+        live, archived = live.where(Order.timestamp >= since), archived.where(OrderArchive.timestamp >= since)
+    if until is not None:
+        live, archived = live.where(Order.timestamp < until), archived.where(OrderArchive.timestamp < until)
+    return db.union_all(live, archived).subquery('orders')
+
+def rebuild_daily_sales(conn, start_day=None, end_day=None):
+    # Полный (или за дни start_day..end_day) пересчет сводки из заказов и архива заказов
+    since = day_start(start_day) if start_day is not None else None
+    until = day_start(end_day + timedelta(days=1)) if end_day is not None else None
+    orders = order_history(since, until)
+    day = local_date(orders.c.timestamp)
+    is_sub = orders.c.status == SUBSCRIPTION_STATUS
+    # Для старых заказов без сохраненной цены берем текущую цену блюда
+    amount = func.coalesce(orders.c.unit_price, MenuItem.price) * orders.c.quantity
+    sales_query = db.select(day, orders.c.item_id, func.sum(orders.c.quantity),
+                            func.sum(db.case((is_sub, orders.c.quantity), else_=0)),
+                            func.sum(db.case((is_sub, 0), else_=amount))) \
+        .join(MenuItem, orders.c.item_id == MenuItem.id).group_by(day, orders.c.item_id)
+    first_orders = db.select(func.min(orders.c.id).label('order_id')).group_by(day, orders.c.user_id).subquery()
+    new_students_query = db.select(day, orders.c.item_id, func.count(orders.c.id)) \
+        .join(first_orders, orders.c.id == first_orders.c.order_id).group_by(day, orders.c.item_id)
+
+    rows = {}
+    for d, item_id, portions, sub_portions, revenue in conn.execute(sales_query):
+        rows[(str(d), item_id)] = {'day': _as_date(d), 'item_id': item_id, 'portions': portions,
+                                   'sub_portions': sub_portions or 0, 'revenue': revenue or 0, 'new_students': 0}
+    for d, item_id, count in conn.execute(new_students_query):
+        rows[(str(d), item_id)]['new_students'] = count
+
+    delete = DailySales.__table__.delete()
+    if start_day is not None:
+        delete = delete.where(DailySales.day >= start_day)
+    if end_day is not None:
+        delete = delete.where(DailySales.day <= end_day)
+    conn.execute(delete)
+    if rows:
+        conn.execute(DailySales.__table__.insert(), list(rows.values()))
+    return len(rows)
+
+@migration('0002_daily_sales_backfill')
+def _migrate_daily_sales(conn):
+    rebuild_daily_sales(conn)
+
+@migration('0003_order_quantity_price')
+def _migrate_order_quantity_price(conn):
+    # Фиксируем цену старых заказов, чтобы правка цены блюда не меняла историю выручки
+    price = db.select(MenuItem.price).where(MenuItem.id == Order.item_id).scalar_subquery()
+    conn.execute(Order.__table__.update().where(Order.unit_price.is_(None)).values(unit_price=price))
+    conn.execute(Order.__table__.update().where(Order.state == ORDER_COMPLETED).values(issued=Order.quantity))
+
+@migration('0004_menu_item_unique_name')
+def _migrate_menu_item_duplicates(conn):
+    # Перед уникальным индексом (name, category) сливаем повторы в позицию с меньшим id:
+    # остатки суммируются, заказы, отзывы и техкарты переносятся, сводка продаж пересчитывается
+    items, recipes = MenuItem.__table__, RecipeIngredient.__table__
+    groups = conn.execute(db.select(items.c.name, items.c.category, func.min(items.c.id))
+                          .group_by(items.c.name, items.c.category).having(func.count() > 1)).all()
+    if not groups:
+        return
+    merged = {}
+    for name, category, keep_id in groups:
+        rows = conn.execute(db.select(items.c.id, items.c.quantity, items.c.is_active)
+                            .where(items.c.name == name, items.c.category == category)).all()
+        for row in rows:
+            if row.id != keep_id:
+                merged[row.id] = keep_id
+        conn.execute(items.update().where(items.c.id == keep_id).values(
+            quantity=sum(row.quantity or 0 for row in rows), is_active=any(row.is_active for row in rows)))
+    for old_id, keep_id in merged.items():
+        conn.execute(Order.__table__.update().where(Order.__table__.c.item_id == old_id).values(item_id=keep_id))
+        conn.execute(Review.__table__.update().where(Review.__table__.c.item_id == old_id).values(item_id=keep_id))
+    # Техкарты: пара (блюдо, продукт) уникальна, поэтому строки переписываются целиком
+    ids = list(merged)
+    affected = conn.execute(db.select(recipes.c.id, recipes.c.dish_id, recipes.c.product_id, recipes.c.amount)
+                            .where(db.or_(recipes.c.dish_id.in_(ids), recipes.c.product_id.in_(ids)))).all()
+    if affected:
+        conn.execute(recipes.delete().where(recipes.c.id.in_([r.id for r in affected])))
+        remaining = {(r.dish_id, r.product_id) for r in conn.execute(db.select(recipes.c.dish_id, recipes.c.product_id))}
+        rows = {}
+        for r in affected:
+            pair = (merged.get(r.dish_id, r.dish_id), merged.get(r.product_id, r.product_id))
+            if pair not in remaining:
+                rows.setdefault(pair, r.amount)
+        if rows:
+            conn.execute(recipes.insert(), [{'dish_id': d, 'product_id': p, 'amount': a} for (d, p), a in rows.items()])
+    conn.execute(items.delete().where(items.c.id.in_(ids)))
+    rebuild_daily_sales(conn)
+
+@app.cli.command('rebuild-daily-sales')
+@click.option('--days', type=int, default=None, help='Пересчитать только последние N дней.')
+def rebuild_daily_sales_command(days):
+    """Пересчитывает сводную таблицу продаж из истории заказов."""
+    start_day = date.today() - timedelta(days=days - 1) if days else None
+    with db.engine.begin() as conn:
+        count = rebuild_daily_sales(conn, start_day)
+    print(f'Сводка продаж пересчитана: {count} строк.')
+
+def recompute_allergen_masks(conn):
+    # Маски из уже введенного текста: один UPDATE на каждое различное значение
+    for table, text, mask in ((User.__table__, 'allergies', 'allergy_mask'), (MenuItem.__table__, 'allergens', 'allergen_mask')):
+        for (value,) in conn.execute(db.select(table.c[text]).where(table.c[text] != '').distinct()):
+            conn.execute(table.update().where(table.c[text] == value).values({mask: allergens.to_mask(value)}))
+
+@migration('0005_allergen_masks')
+def _migrate_allergen_masks(conn):
+    recompute_allergen_masks(conn)
+
+@migration('0006_allergen_negations')
+def _migrate_allergen_negations(conn):
+    # Разбор стал учитывать отрицания ("без глютена") и короткие основы: маски пересчитываются
+    recompute_allergen_masks(conn)
+
+@app.cli.command('archive-history')
+@click.option('--order-days', type=int, default=None, help='Хранить выполненные заказы N дней (по умолчанию ORDER_RETENTION_DAYS).')
+@click.option('--notification-days', type=int, default=None, help='Хранить прочитанные уведомления N дней.')
+def archive_history_command(order_days, notification_days):
+    """Переносит старые выполненные заказы в архив и удаляет старые прочитанные уведомления."""
+    result = archive_history(order_days, notification_days)
+    print(f"Заказов в архив: {result['orders_archived']}, уведомлений удалено: {result['notifications_deleted']}, "
+          f"рассылок удалено: {result['broadcasts_deleted']}, дней сводки пересчитано: {result['days_rebuilt']} "
+          f"({result['seconds']} с).")
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Обновляет схему существующей базы до текущих моделей."""
+    migrate_schema()
+    print('Схема базы данных обновлена.')
 
 # --- ИНИЦИАЛИЗАЦИЯ БД (Важно для Render) ---
 with app.app_context():
-    db.create_all()
+    migrate_schema()
     # Автоматическое создание админа, если база пуста
     if not User.query.filter_by(role='admin').first():
-        hashed_pw = generate_password_hash('admin', method='scrypt')
+        hashed_pw = hash_password('admin')
         admin = User(username='admin', password_hash=hashed_pw, role='admin')
         db.session.add(admin)
         db.session.commit()
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ УВЕДОМЛЕНИЙ ---
+# Запрос только ставит уведомление в очередь и сразу отвечает. Фоновый поток забирает
+# очередь пачками и пишет её одним executemany на таблицу. Рассылка по роли хранится
+# одной строкой BroadcastMessage, а не копией на каждого получателя.
+class NotificationDispatcher:
+    def __init__(self, batch_size=500, idle_timeout=1.0):
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.stats = {'enqueued': 0, 'batches': 0, 'jobs': 0, 'rows_written': 0, 'errors': 0,
+                      'write_seconds': 0.0, 'last_batch_ms': 0.0}
+
+    def _ensure_started(self):
+        # Поток запускается лениво: после fork'а gunicorn'а у каждого worker'а - свой
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+                    self._thread.start()
+
+    def submit(self, kind, target, message):
+        self.submit_many([(kind, target, message)])
+
+    def submit_many(self, items):
+        # Массовые операции ставят все уведомления разом: в синхронном режиме - одна запись
+        now = datetime.utcnow()
+        jobs = [(kind, target, message, now) for kind, target, message in items]
+        if not jobs:
+            return
+        # Счетчики меняют потоки запросов и поток записи: под блокировкой, иначе инкременты теряются
+        with self._lock:
+            self.stats['enqueued'] += len(jobs)
+        if not app.config['NOTIFICATIONS_ASYNC']:
+            self._write(jobs)
+            return
+        self._ensure_started()
+        for job in jobs:
+            self.queue.put(job)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.idle_timeout)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        personal = [{'user_id': target, 'message': message, 'is_read': False, 'created_at': created_at}
+                    for kind, target, message, created_at in batch if kind == 'user']
+        broadcasts = [{'role': target, 'message': message, 'created_at': created_at}
+                      for kind, target, message, created_at in batch if kind == 'role']
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                if personal:
+                    conn.execute(Notification.__table__.insert(), personal)
+                    recipients = {row['user_id'] for row in personal}
+                    conn.execute(User.__table__.update().where(User.id.in_(recipients))
+                                 .values(notif_version=User.notif_version + 1))
+                if broadcasts:
+                    conn.execute(BroadcastMessage.__table__.insert(), broadcasts)
+                rows = len(personal) + len(broadcasts)
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            app.logger.exception('Не удалось записать пачку уведомлений (%d шт.)', len(batch))
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['jobs'] += len(batch)
+            self.stats['rows_written'] += rows
+            self.stats['write_seconds'] += elapsed
+            self.stats['last_batch_ms'] = round(elapsed * 1000, 2)
+
+    def flush(self):
+        # Дождаться записи всего, что уже поставлено в очередь
+        self.queue.join()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        uptime = max(time.time() - self.started_at, 1e-9)
+        stats['queue_size'] = self.queue.qsize()
+        stats['rows_per_second'] = round(stats['rows_written'] / uptime, 2)
+        stats['rows_per_write_second'] = round(stats['rows_written'] / stats['write_seconds'], 1) if stats['write_seconds'] else 0.0
+        stats['write_seconds'] = round(stats['write_seconds'], 3)
+        return stats
+
+notification_dispatcher = NotificationDispatcher()
+atexit.register(notification_dispatcher.flush)
+
+def latest_broadcast_id(role):
+    return db.session.query(func.max(BroadcastMessage.id)).filter(BroadcastMessage.role == role).scalar() or 0
+
+def notification_state(user_id):
+    # Один дешевый запрос без таблицы Notification: версия личных уведомлений,
+    # отметка прочитанного и номер последней рассылки для роли пользователя
+    latest = db.select(func.max(BroadcastMessage.id)).where(BroadcastMessage.role == User.role).scalar_subquery()
+    version, watermark, latest_id = db.session.query(User.notif_version, User.broadcast_read_id, latest) \
+        .filter(User.id == user_id).one()
+    return f'n{version}-b{latest_id or 0}', watermark or 0
+
+def notification_feed(user_id, role, watermark, limit=10):
+    # Личные уведомления и рассылки для роли одним запросом; число непрочитанных
+    # считается оконной функцией по всему набору, до LIMIT
+    personal = db.select(Notification.id.label('id'), db.literal('personal').label('kind'), Notification.message.label('message'),
+                         Notification.is_read.label('is_read'), Notification.created_at.label('created_at')) \
+        .where(Notification.user_id == user_id)
+    broadcast = db.select(BroadcastMessage.id, db.literal('broadcast'), BroadcastMessage.message,
+                          BroadcastMessage.id <= watermark, BroadcastMessage.created_at) \
+        .where(BroadcastMessage.role == role)
+    feed = db.union_all(personal, broadcast).subquery()
+    unread = func.sum(db.case((feed.c.is_read == False, 1), else_=0)).over()
+    rows = db.session.execute(db.select(feed, unread.label('unread'))
+                              .order_by(feed.c.is_read.asc(), feed.c.created_at.desc())
+                              .limit(limit)).all()
+    unread_count = rows[0].unread if rows else 0
+    return rows, unread_count or 0
+
+def with_notification_etag(response, etag):
+    # no-cache: браузер хранит ответ, но каждый раз сверяет ETag (If-None-Match) с сервером
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def notifications_not_modified(etag):
+    return with_notification_etag(app.response_class(status=304), etag)
+
 def notify_user(user_id, message):
-    notif = Notification(user_id=user_id, message=message)
-    db.session.add(notif)
+    notification_dispatcher.submit('user', user_id, message)
 
 def notify_role(role, message):
-    users = User.query.filter_by(role=role).all()
-    for user in users:
-        notify_user(user.id, message)
+    notification_dispatcher.submit('role', role, message)
+
+def notify_users(messages):
+    # messages: список пар (user_id, текст)
+    notification_dispatcher.submit_many([('user', user_id, message) for user_id, message in messages])
+
+# --- ЖИВАЯ ЛЕНТА ЗАКАЗОВ (SSE) ---
+# Экраны кухни подписываются на /api/orders/stream и получают только изменения
+# очереди вместо повторного чтения всей таблицы заказов каждые 5 секунд.
+# Изменения пишутся в журнал OrderEvent в той же транзакции, что и заказ, поэтому их видят все worker'ы:
+# фоновый поток каждого worker'а раз в ORDER_FEED_POLL_SECONDS читает новые события одним запросом по
+# первичному ключу и раздает их своим подписчикам (как MenuCache сверяет версию меню).
+ORDER_STREAM_HEARTBEAT = 15 # Секунд между keep-alive комментариями
+ORDER_STREAM_MAX_AGE = 300 # Через сколько секунд закрыть поток (браузер переподключится сам)
+ORDER_STREAM_RETRY_MS = 3000 # Пауза переподключения браузера, когда сервер не держит поток (sync-worker)
+ORDER_FEED_POLL_SECONDS = 1.0
+# Сколько последних id журнала перечитывать: в PostgreSQL строки с меньшим id могут зафиксироваться позже
+ORDER_FEED_LOOKBACK = 200
+ORDER_EVENT_RETENTION = 600 # Секунд хранения событий журнала
+ORDER_EVENT_PRUNE_SECONDS = 60
+
+class OrderFeed:
+    def __init__(self, max_queue=256, poll_seconds=ORDER_FEED_POLL_SECONDS):
+        self.max_queue = max_queue
+        self.poll_seconds = poll_seconds
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None # None - журнал еще не прочитан этим worker'ом (или подписчиков не было)
+        self._seen = set()
+
+    def _ensure_started(self):
+        # Поток запускается лениво: после fork'а gunicorn'а у каждого worker'а - свой
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='order-feed', daemon=True)
+                    self._thread.start()
+
+    def subscribe(self):
+        # Вызывать до чтения снимка очереди: события после него придут в поток
+        self._ensure_started()
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            if self._last_id is None:
+                self._poll(deliver=False) # Уже записанное отражено в снимке
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data):
+        # Вызывать до commit: событие фиксируется вместе с изменением заказа или не фиксируется вовсе
+        self._ensure_started()
+        db.session.execute(OrderEvent.__table__.insert().values(
+            event=event, payload=json.dumps(data, ensure_ascii=False), created_at=datetime.utcnow()))
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                with app.app_context():
+                    with self._lock:
+                        if self._subscribers:
+                            self._poll(deliver=True)
+                        else:
+                            self._last_id = None
+                    if time.time() - last_prune >= ORDER_EVENT_PRUNE_SECONDS:
+                        last_prune = time.time()
+                        self._prune()
+            except Exception:
+                app.logger.exception('Не удалось прочитать журнал событий кухни')
+
+    def _poll(self, deliver):
+        # Вызывать под self._lock
+        table = OrderEvent.__table__
+        query = db.select(table.c.id, table.c.event, table.c.payload)
+        if self._last_id is None:
+            query = query.order_by(table.c.id.desc()).limit(ORDER_FEED_LOOKBACK)
+        else:
+            query = query.where(table.c.id > self._last_id - ORDER_FEED_LOOKBACK).order_by(table.c.id)
+        with db.engine.connect() as conn:
+            rows = sorted(conn.execute(query).all(), key=lambda row: row.id)
+        fresh = [row for row in rows if row.id not in self._seen]
+        self._seen.update(row.id for row in fresh)
+        self._last_id = max([self._last_id or 0] + [row.id for row in fresh])
+        self._seen = {event_id for event_id in self._seen if event_id > self._last_id - ORDER_FEED_LOOKBACK}
+        if deliver:
+            for row in fresh:
+                self._deliver(row.event, json.loads(row.payload))
+
+    def _deliver(self, event, data):
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                # Клиент не успевает читать: очищаем очередь и просим его перечитать список целиком
+                while not q.empty():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                q.put_nowait(('resync', {}))
+
+    def _prune(self):
+        # Последнее событие оставляем: в SQLite новый id - max(id) + 1, и он совпал бы с уже прочитанным
+        table = OrderEvent.__table__
+        newest = db.select(func.max(table.c.id)).scalar_subquery()
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(
+                table.c.created_at < datetime.utcnow() - timedelta(seconds=ORDER_EVENT_RETENTION), table.c.id < newest))
+
+order_feed = OrderFeed()
+
+def order_payload(order_id, username, item_name, quantity, issued, timestamp, status, serve_date=None, slot=None):
+    return {
+        'id': order_id,
+        'username': username,
+        'item_name': item_name,
+        'quantity': quantity,
+        'issued': issued,
+        'timestamp': timestamp.strftime('%H:%M'),
+        'status': status,
+        'serve_date': serve_date.isoformat() if serve_date else None,
+        'slot': slot
+    }
+
+# --- ЗАПРОСЫ К ЗАКАЗАМ ---
+# Единый слой чтения очереди кухни: только нужные колонки, пользователь и блюдо
+# подтягиваются JOIN'ом в том же запросе (без ленивой загрузки order.user / order.item).
+def open_orders_filter():
+    # Активные заказы: Оплаченные или Оформленные, но не Выполненные (индекс state, timestamp)
+    return Order.state == ORDER_OPEN
+
+def open_orders_rows(partition=None):
+    # partition - (день, перемена, с просроченными), см. kitchen_partition; None - вся очередь
+    query = db.session.query(Order.id, User.username, MenuItem.name, Order.quantity, Order.issued, Order.timestamp,
+                             Order.status, Order.serve_date, Order.slot) \
+        .join(User, Order.user_id == User.id) \
+        .join(MenuItem, Order.item_id == MenuItem.id) \
+        .filter(open_orders_filter())
+    if partition is not None:
+        query = query.filter(slot_partition_filter(*partition))
+    return query.order_by(Order.timestamp).all()
+
+def open_orders_data(partition=None):
+    return [order_payload(*row) for row in open_orders_rows(partition)]
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# --- ОТЧЕТЫ И АНАЛИТИКА ---
+# Суммы по дням считаются одним GROUP BY на весь период, а не отдельным запросом на каждый день:
+# отчет за 365 дней стоит столько же запросов, сколько отчет за 7.
+REPORT_MAX_DAYS = 366
+
+def daily_revenue(start_day, end_day):
+    rows = db.session.query(DailySales.day, func.sum(DailySales.revenue)) \
+        .filter(DailySales.day >= start_day, DailySales.day <= end_day) \
+        .group_by(DailySales.day).all()
+    return {_as_date(d): total or 0 for d, total in rows}
+
+def daily_supply_spend(start_day, end_day):
+    day = local_date(SupplyRequest.created_at)
+    rows = db.session.query(day, func.sum(SupplyRequest.total_cost)) \
+        .filter(SupplyRequest.created_at >= day_start(start_day), SupplyRequest.created_at < day_start(end_day + timedelta(days=1)),
+                SupplyRequest.status == 'Approved') \
+        .group_by(day).all()
+    return {_as_date(d): total or 0 for d, total in rows}
+
+def daily_report(start_day, end_day):
+    # Строки отчета от новых дней к старым, дни без продаж заполняются нулями
+    revenue = daily_revenue(start_day, end_day)
+    expenses = daily_supply_spend(start_day, end_day)
+    rows = []
+    d = end_day
+    while d >= start_day:
+        sales = revenue.get(d, 0)
+        spent = expenses.get(d, 0)
+        rows.append({'date': d, 'sales': sales, 'expenses': spent, 'profit': sales - spent})
+        d -= timedelta(days=1)
+    return rows
+
+def report_period(args, default_days=30):
+    # Период из параметров запроса: ?start=YYYY-MM-DD&end=YYYY-MM-DD или ?days=N
+    today = date.today()
+    end_day = datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end') else today
+    if args.get('start'):
+        start_day = datetime.strptime(args['start'], '%Y-%m-%d').date()
+    else:
+        days = min(max(args.get('days', default_days, type=int), 1), REPORT_MAX_DAYS)
+        start_day = end_day - timedelta(days=days - 1)
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+    start_day = max(start_day, end_day - timedelta(days=REPORT_MAX_DAYS - 1))
+    return start_day, end_day
+
+# --- ВЫГРУЗКА ЗАКАЗОВ ---
+# Выгрузка за учебный год - сотни тысяч строк. Строки читаются из базы пачками (yield_per,
+# на PostgreSQL - серверный курсор) и сразу отдаются клиенту генератором: память не растет
+# с размером периода. По запросу поток сжимается gzip на лету. Архивные заказы входят в выгрузку.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ['ID заказа', 'Дата и время', 'Ученик', 'Блюдо', 'Категория', 'Порций', 'Выдано',
+                  'Цена порции (Руб)', 'Сумма (Руб)', 'Оплата', 'Состояние']
+
+def export_filters(args, orders):
+    # Фильтры выгрузки: ?item_id=, ?category=, ?user=, ?payment=paid|subscription, ?state=open|completed
+    # orders - выборка order_history()
+    conditions = []
+    if args.get('item_id'):
+        conditions.append(orders.c.item_id == int(args['item_id']))
+    if args.get('category'):
+        conditions.append(MenuItem.category == args['category'])
+    if args.get('user'):
+        conditions.append(User.username == args['user'])
+    if args.get('payment'):
+        if args['payment'] not in ('paid', 'subscription'):
+            raise ValueError(args['payment'])
+        by_subscription = orders.c.status == SUBSCRIPTION_STATUS
+        conditions.append(by_subscription if args['payment'] == 'subscription' else ~by_subscription)
+    if args.get('state'):
+        if args['state'] not in (ORDER_OPEN, ORDER_COMPLETED):
+            raise ValueError(args['state'])
+        conditions.append(orders.c.state == args['state'])
+    return conditions
+
+def order_export_query(orders, conditions):
+    unit_price = func.coalesce(orders.c.unit_price, MenuItem.price)
+    total = db.case((orders.c.status == SUBSCRIPTION_STATUS, 0), else_=unit_price * orders.c.quantity)
+    return db.select(orders.c.id, orders.c.timestamp, User.username, MenuItem.name, MenuItem.category, orders.c.quantity,
+                     orders.c.issued, unit_price, total, orders.c.status, orders.c.state) \
+        .join(User, orders.c.user_id == User.id) \
+        .join(MenuItem, orders.c.item_id == MenuItem.id) \
+        .where(*conditions) \
+        .order_by(orders.c.timestamp, orders.c.id)
+
+def export_csv_chunks(stmt):
+    # Одна пачка строк из базы - один кусок ответа. BOM нужен, чтобы Excel открыл UTF-8 с кириллицей.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for rows in result.partitions():
+        for row in rows:
+            writer.writerow([row[0], row[1].strftime('%Y-%m-%d %H:%M:%S'), *row[2:]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    result.close()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31: формат gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# --- АРХИВ И ОЧИСТКА ИСТОРИИ ---
+# Очередь кухни, уведомления и отчеты постоянно читают таблицы заказов и уведомлений, а те растут
+# годами. Архивация переносит выполненные заказы старше ORDER_RETENTION_DAYS в OrderArchive и удаляет
+# прочитанные уведомления и рассылки старше NOTIFICATION_RETENTION_DAYS (0 - шаг выключен).
+# Работа идет пачками по ARCHIVE_BATCH_SIZE строк: каждая пачка - отдельная короткая транзакция,
+# между пачками пауза, поэтому блокировка записи SQLite не отнимает у покупок больше миллисекунд.
+# Перед переносом пачки проверяется, что её продажи уже есть в сводке DailySales.
+ARCHIVE_PAUSE_SECONDS = 0.05
+ARCHIVE_CHECK_SECONDS = 600 # Как часто фоновый поток проверяет, не пора ли запускаться
+
+archive_state = {'last_run': None}
+
+def ensure_daily_sales(conn, order_ids):
+    # Дни, где у заказа пачки нет строки сводки, пересчитываются до переноса. Возвращает число таких дней
+    day = local_date(Order.timestamp)
+    covered = db.select(DailySales.id).where(DailySales.day == day, DailySales.item_id == Order.item_id).exists()
+    missing = conn.execute(db.select(day).where(Order.id.in_(order_ids), ~covered).distinct()).scalars().all()
+    for d in missing:
+        rebuild_daily_sales(conn, _as_date(d), _as_date(d))
+    return len(missing)
+
+def archive_orders(cutoff, batch_size):
+    columns = ['id', 'user_id', 'item_id', 'status', 'quantity', 'unit_price', 'issued', 'timestamp', 'serve_date', 'slot']
+    orders = Order.__table__
+    moved = rebuilt = 0
+    while True:
+        with db.engine.begin() as conn:
+            # Последний заказ не трогаем: SQLite выдает новому заказу max(id) + 1, и id совпал бы с архивным
+            newest = db.select(func.max(orders.c.id)).scalar_subquery()
+            ids = conn.execute(db.select(orders.c.id)
+                               .where(orders.c.state == ORDER_COMPLETED, orders.c.timestamp < cutoff, orders.c.id < newest)
+                               .order_by(orders.c.timestamp).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            rebuilt += ensure_daily_sales(conn, ids)
+            conn.execute(OrderArchive.__table__.insert().from_select(
+                columns, db.select(*[orders.c[name] for name in columns]).where(orders.c.id.in_(ids))))
+            conn.execute(orders.delete().where(orders.c.id.in_(ids)))
+        moved += len(ids)
+        time.sleep(ARCHIVE_PAUSE_SECONDS)
+    return moved, rebuilt
+
+def purge_notifications(cutoff, batch_size):
+    table = Notification.__table__
+    deleted = 0
+    while True:
+        with db.engine.begin() as conn:
+            ids = conn.execute(db.select(table.c.id).where(table.c.is_read == True, table.c.created_at < cutoff)
+                               .order_by(table.c.id).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            user_ids = set(conn.execute(table.delete().where(table.c.id.in_(ids)).returning(table.c.user_id)).scalars())
+            # Лента уведомлений кэшируется клиентом по ETag: новая версия, чтобы удаленное не показывалось
+            conn.execute(User.__table__.update().where(User.__table__.c.id.in_(user_ids))
+                         .values(notif_version=User.__table__.c.notif_version + 1))
+        deleted += len(ids)
+        time.sleep(ARCHIVE_PAUSE_SECONDS)
+    return deleted
+
+def purge_broadcasts(cutoff, batch_size):
+    table = BroadcastMessage.__table__
+    deleted = 0
+    while True:
+        with db.engine.begin() as conn:
+            # Последнюю рассылку оставляем: иначе её id достанется новой, а отметки прочитанного (broadcast_read_id)
+            # сочтут новую рассылку уже прочитанной
+            newest = db.select(func.max(table.c.id)).scalar_subquery()
+            ids = conn.execute(db.select(table.c.id).where(table.c.created_at < cutoff, table.c.id < newest)
+                               .order_by(table.c.id).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+        deleted += len(ids)
+        time.sleep(ARCHIVE_PAUSE_SECONDS)
+    return deleted
+
+def archive_history(order_days=None, notification_days=None, now=None):
+    now = now or datetime.utcnow()
+    order_days = app.config['ORDER_RETENTION_DAYS'] if order_days is None else order_days
+    notification_days = app.config['NOTIFICATION_RETENTION_DAYS'] if notification_days is None else notification_days
+    batch_size = app.config['ARCHIVE_BATCH_SIZE']
+    started = time.perf_counter()
+    result = {'orders_archived': 0, 'days_rebuilt': 0, 'notifications_deleted': 0, 'broadcasts_deleted': 0}
+    if order_days > 0:
+        result['orders_archived'], result['days_rebuilt'] = archive_orders(now - timedelta(days=order_days), batch_size)
+    if notification_days > 0:
+        cutoff = now - timedelta(days=notification_days)
+        result['notifications_deleted'] = purge_notifications(cutoff, batch_size)
+        result['broadcasts_deleted'] = purge_broadcasts(cutoff, batch_size)
+    result.update(finished_at=datetime.utcnow().isoformat(timespec='seconds'),
+                  seconds=round(time.perf_counter() - started, 2))
+    archive_state['last_run'] = result
+    return result
+
+def claim_periodic_run(name, interval_seconds):
+    # Время последнего запуска (unix) хранится в AppCounter: из нескольких worker'ов запустится один
+    now = int(time.time())
+    table = AppCounter.__table__
+    stmt = _upsert(table).values(name=name, value=now).on_conflict_do_update(
+        index_elements=['name'], set_={'value': now}, where=table.c.value <= now - interval_seconds)
+    claimed = db.session.execute(stmt.returning(table.c.value)).scalar()
+    db.session.commit()
+    return claimed is not None
+
+class ArchiveScheduler:
+    def __init__(self, interval_seconds):
+        self.interval = interval_seconds
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='archive-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.interval, ARCHIVE_CHECK_SECONDS))
+            try:
+                with app.app_context():
+                    if claim_periodic_run('archive_run', self.interval):
+                        result = archive_history()
+                        app.logger.info('Архивация истории: %s', result)
+            except Exception:
+                app.logger.exception('Ошибка архивации истории')
+
+if app.config['ARCHIVE_INTERVAL_HOURS'] > 0:
+    ArchiveScheduler(app.config['ARCHIVE_INTERVAL_HOURS'] * 3600).start()
+
+# --- КЭШ МЕНЮ УЧЕНИКА ---
+# Меню меняется только при add_dish / publish_dish / bulk_update_menu, а читается каждым учеником
+# при входе. Снимок меню строится один раз на версию: версия хранится в AppCounter и увеличивается
+# в той же транзакции, что и изменение блюд, поэтому её видят все worker'ы.
+# Остатки меняются при каждой покупке, поэтому они читаются отдельно и кэшируются на MENU_CACHE_SECONDS.
+# Последние отзывы тоже отдельно: новый отзыв не перестраивает снимок, блок отзывов живет MENU_REVIEWS_CACHE_SECONDS.
+def bump_counter(name):
+    table = AppCounter.__table__
+    stmt = _upsert(table).values(name=name, value=1)
+    stmt = stmt.on_conflict_do_update(index_elements=['name'], set_={'value': table.c.value + 1})
+    return db.session.execute(stmt.returning(table.c.value)).scalar()
+
+def counter_value(name):
+    return db.session.query(AppCounter.value).filter(AppCounter.name == name).scalar() or 0
+
+def build_menu_snapshot():
+    items = db.session.query(MenuItem.id, MenuItem.name, MenuItem.price, MenuItem.category, MenuItem.allergens,
+                             MenuItem.allergen_mask, MenuItem.date) \
+        .filter(MenuItem.is_active == True).order_by(MenuItem.id).all()
+    return [SimpleNamespace(id=i.id, name=i.name, price=i.price, category=i.category, allergens=i.allergens or '',
+                            allergen_mask=i.allergen_mask or 0, date=i.date) for i in items]
+
+def load_recent_reviews():
+    # Последние 3 отзыва на каждое блюдо меню одним запросом
+    position = func.row_number().over(partition_by=Review.item_id, order_by=Review.id.desc()).label('position')
+    active = db.select(MenuItem.id).where(MenuItem.is_active == True)
+    recent = db.select(Review.item_id, Review.rating, Review.comment, Review.id, position) \
+        .where(Review.item_id.in_(active)).subquery()
+    reviews = {}
+    for row in db.session.execute(db.select(recent).where(recent.c.position <= 3).order_by(recent.c.id)):
+        reviews.setdefault(row.item_id, []).append(SimpleNamespace(rating=row.rating, comment=row.comment))
+    return reviews
+
+class MenuCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.items = []
+        self.checked_at = 0.0
+        self.stock = {}
+        self.stock_loaded_at = 0.0
+        self.reviews = {}
+        self.reviews_loaded_at = 0.0
+        self.stats = {'hits': 0, 'version_checks': 0, 'rebuilds': 0, 'stock_loads': 0, 'review_loads': 0}
+
+    def invalidate(self):
+        # Локальная запись: следующий запрос сразу сверит версию и остатки
+        self.checked_at = 0.0
+        self.stock_loaded_at = 0.0
+
+    def invalidate_reviews(self):
+        # Автор отзыва видит его сразу; другие worker'ы - через MENU_REVIEWS_CACHE_SECONDS
+        self.reviews_loaded_at = 0.0
+
+    def snapshot(self):
+        ttl = app.config['MENU_CACHE_SECONDS']
+        with self._lock: # Один поток перестраивает снимок, остальные ждут готовый
+            now = time.monotonic()
+            if self.version is not None and now - self.checked_at < ttl:
+                self.stats['hits'] += 1
+                return self.version, self.items
+            version = counter_value('menu')
+            self.stats['version_checks'] += 1
+            if version != self.version:
+                self.items = build_menu_snapshot()
+                self.version = version
+                self.stats['rebuilds'] += 1
+            self.checked_at = now
+            return self.version, self.items
+
+    def stock_levels(self):
+        ttl = app.config['MENU_CACHE_SECONDS']
+        with self._lock:
+            now = time.monotonic()
+            if now - self.stock_loaded_at >= ttl:
+                self.stock = dict(db.session.query(MenuItem.id, MenuItem.quantity).filter(MenuItem.is_active == True).all())
+                self.stock_loaded_at = now
+                self.stats['stock_loads'] += 1
+            return self.stock
+
+    def recent_reviews(self):
+        ttl = app.config['MENU_REVIEWS_CACHE_SECONDS']
+        with self._lock:
+            now = time.monotonic()
+            if now - self.reviews_loaded_at >= ttl:
+                self.reviews = load_recent_reviews()
+                self.reviews_loaded_at = now
+                self.stats['review_loads'] += 1
+            return self.reviews
+
+    def available_items(self):
+        # Снимок меню с актуальными остатками и отзывами; закончившиеся блюда скрываются
+        version, items = self.snapshot()
+        stock = self.stock_levels()
+        reviews = self.recent_reviews()
+        menu = []
+        for item in items:
+            quantity = stock.get(item.id) or 0
+            if quantity > 0:
+                menu.append(SimpleNamespace(**vars(item), quantity=quantity, reviews=reviews.get(item.id, [])))
+        return version, menu
+
+menu_cache = MenuCache()
+
+def menu_changed():
+    # Вызывать до commit: версия меню увеличивается в той же транзакции. Возвращает новую версию
+    version = bump_counter('menu')
+    menu_cache.invalidate()
+    return version
+
+# --- ПРОГНОЗ ЗАКУПОК ---
+# Закупаются продукты склада (category='product'). Их расход за день - продажи блюд из сводки
+# DailySales, умноженные на техкарты (RecipeIngredient); по нему скользящее среднее с учетом
+# дня недели, см. forecast.py. Уже ожидающие согласования заявки вычитаются из потребности.
+# Продукты, которых нет ни в одной техкарте, заказываются по прежнему правилу порога остатка.
+FORECAST_HISTORY_DAYS = 365
+
+def supply_forecast(today=None):
+    today = today or date.today()
+    start_day = today - timedelta(days=FORECAST_HISTORY_DAYS - 1)
+    items = db.session.query(MenuItem.id, MenuItem.name, MenuItem.quantity) \
+        .filter(MenuItem.category == 'product').order_by(MenuItem.id).all()
+    if not items:
+        return []
+    pending = dict(db.session.query(SupplyRequest.product_name, func.sum(SupplyRequest.quantity))
+                   .filter(SupplyRequest.status == 'Pending').group_by(SupplyRequest.product_name).all())
+    index = {item.id: i for i, item in enumerate(items)}
+    # Расход считаем по текущим техкартам: изменение рецепта сразу меняет прогноз
+    recipes = [r for r in db.session.query(RecipeIngredient.product_id, RecipeIngredient.dish_id, RecipeIngredient.amount)
+               if r.product_id in index]
+    dish_ids = sorted({r.dish_id for r in recipes})
+    dish_index = {dish_id: i for i, dish_id in enumerate(dish_ids)}
+    history = db.session.query(DailySales.item_id, DailySales.day, DailySales.portions) \
+        .filter(DailySales.day >= start_day, DailySales.day <= today, DailySales.item_id.in_(dish_ids)).all() if dish_ids else []
+
+    rows = [(dish_index[item_id], (_as_date(day) - start_day).days, portions) for item_id, day, portions in history]
+    dish_rows, day_offsets, portions = zip(*rows) if rows else ((), (), ())
+    sales = forecast.consumption_matrix(dish_ids, start_day, today, dish_rows, day_offsets, portions)
+    matrix = forecast.recipe_consumption(sales, len(items), [index[r.product_id] for r in recipes],
+                                         [dish_index[r.dish_id] for r in recipes], [r.amount for r in recipes])
+    return forecast.reorder_plan([i.id for i in items], [i.name for i in items],
+                                 [i.quantity or 0 for i in items], [pending.get(i.name, 0) for i in items],
+                                 matrix, start_day, today)
+
+@app.cli.command('supply-forecast')
+def supply_forecast_command():
+    """Показывает рассчитанные автозаявки на закупку, не создавая их."""
+    started = time.perf_counter()
+    plan = supply_forecast()
+    for p in plan:
+        print(f"{p['priority']:<8} {p['name']:<30} {p['quantity']:>6} (прогноз {p['forecast']}, остаток {p['stock']}, в заявках {p['pending']})")
+    print(f'Позиций к закупке: {len(plan)}, расчет занял {(time.perf_counter() - started) * 1000:.0f} мс.')
+
+# --- ОТЗЫВЫ ДЛЯ АДМИНИСТРАТОРА ---
+# Лента отзывов читается страницами фиксированного размера с курсором (keyset): следующая страница
+# начинается строго после последней показанной строки по ключу сортировки + id, поэтому стоимость
+# страницы не зависит от того, как далеко пролистали (в отличие от OFFSET). Автор и блюдо
+# подтягиваются JOIN'ом в том же запросе.
+REVIEW_PAGE_SIZE = 20
+REVIEW_PAGE_MAX = 100
+REVIEW_SORTS = {
+    # сортировка: (колонка, по убыванию)
+    'newest': (Review.timestamp, True),
+    'oldest': (Review.timestamp, False),
+    'rating_high': (Review.rating, True),
+    'rating_low': (Review.rating, False),
+}
+
+def encode_cursor(value, row_id):
+    # Непрозрачный курсор страницы: значение ключа сортировки и id последней строки
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, as_datetime=False):
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if as_datetime:
+            value = datetime.fromisoformat(value)
+        return value, int(last_id)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Некорректный курсор')
+
+def encode_review_cursor(sort_by, row):
+    return encode_cursor(row.timestamp if REVIEW_SORTS[sort_by][0] is Review.timestamp else row.rating, row.id)
+
+def decode_review_cursor(sort_by, cursor):
+    return decode_cursor(cursor, as_datetime=REVIEW_SORTS[sort_by][0] is Review.timestamp)
+
+def review_page(sort_by='newest', cursor=None, limit=REVIEW_PAGE_SIZE, item_id=None):
+    # Возвращает (строки, курсор следующей страницы или None)
+    if sort_by not in REVIEW_SORTS:
+        raise ValueError('Неизвестная сортировка')
+    column, descending = REVIEW_SORTS[sort_by]
+    query = db.session.query(Review.id, Review.timestamp, Review.rating, Review.comment, Review.item_id,
+                             User.username, MenuItem.name.label('item_name')) \
+        .join(User, Review.user_id == User.id) \
+        .join(MenuItem, Review.item_id == MenuItem.id)
+    if item_id is not None:
+        query = query.filter(Review.item_id == item_id)
+    if cursor:
+        value, last_id = decode_review_cursor(sort_by, cursor)
+        if descending:
+            query = query.filter(db.or_(column < value, db.and_(column == value, Review.id < last_id)))
+        else:
+            query = query.filter(db.or_(column > value, db.and_(column == value, Review.id > last_id)))
+    order = (column.desc(), Review.id.desc()) if descending else (column.asc(), Review.id.asc())
+    rows = query.order_by(*order).limit(limit + 1).all()
+    next_cursor = encode_review_cursor(sort_by, rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def review_summary():
+    # Средняя оценка, число отзывов и распределение 1-5 по каждому блюду одним GROUP BY
+    distribution = [func.sum(db.case((Review.rating == stars, 1), else_=0)).label(f'stars_{stars}') for stars in range(1, 6)]
+    rows = db.session.query(Review.item_id, MenuItem.name, func.avg(Review.rating).label('average'),
+                            func.count(Review.id).label('count'), *distribution) \
+        .join(MenuItem, Review.item_id == MenuItem.id) \
+        .group_by(Review.item_id, MenuItem.name) \
+        .order_by(func.avg(Review.rating).desc(), MenuItem.name).all()
+    return [{
+        'item_id': row.item_id,
+        'name': row.name,
+        'average': round(float(row.average), 2),
+        'count': row.count,
+        'distribution': {stars: getattr(row, f'stars_{stars}') or 0 for stars in range(1, 6)},
+    } for row in rows]
+
+def review_payload(row):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'item_id': row.item_id,
+        'item_name': row.item_name,
+        'rating': row.rating,
+        'comment': row.comment,
+        'date': row.timestamp.strftime('%d.%m.%Y'),
+    }
+
+# --- ВКЛАДКИ ПАНЕЛИ ПОВАРА ---
+# Страница повара отдается пустой оболочкой; содержимое вкладки рендерится из макросов
+# _cook_tabs.html только когда вкладку открывают (/api/cook/tabs/<вкладка>). История заявок
+# читается страницами по курсору (created_at, id), поэтому время ответа не растет с историей.
+SUPPLY_HISTORY_PAGE_SIZE = 20
+
+def dishes_query():
+    return MenuItem.query.filter(MenuItem.category.in_(['breakfast', 'lunch']))
+
+def active_dishes():
+    return dishes_query().filter(MenuItem.is_active == True).order_by(MenuItem.quantity.desc()).all()
+
+def supply_request_page(cursor=None, limit=SUPPLY_HISTORY_PAGE_SIZE):
+    query = SupplyRequest.query
+    if cursor:
+        created_at, last_id = decode_cursor(cursor, as_datetime=True)
+        query = query.filter(db.or_(SupplyRequest.created_at < created_at,
+                                    db.and_(SupplyRequest.created_at == created_at, SupplyRequest.id < last_id)))
+    rows = query.order_by(SupplyRequest.created_at.desc(), SupplyRequest.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def cook_fragment(macro, *args):
+    return get_template_attribute('_cook_tabs.html', macro)(*args)
+
+def cook_tab_fragments(tab):
+    # {id элемента на странице: HTML}
+    if tab == 'dispatch':
+        return {'cook-active-body': cook_fragment('active_dish_rows', active_dishes())}
+    if tab == 'menu':
+        # Названия блюд для формы подсказывает /api/dishes/autocomplete
+        return {'cook-restock-body': cook_fragment('restock_rows', active_dishes())}
+    if tab == 'warehouse':
+        drafts = dishes_query().filter(MenuItem.is_active == False).order_by(MenuItem.date.desc()).all()
+        products = MenuItem.query.filter_by(category='product').all()
+        return {'cook-drafts-body': cook_fragment('draft_dish_rows', drafts),
+                'cook-products-body': cook_fragment('product_rows', products)}
+    return None
+
+# --- ПОДСКАЗКИ НАЗВАНИЙ БЛЮД ---
+# Форма add_dish подсказывает существующие блюда по первым буквам. Названия держатся в памяти
+# в отсортированном списке ключей (название и каждое его слово с начала, в нижнем регистре),
+# поиск префикса - bisect, O(log n + k). Новое блюдо вставляется в список сразу (insort), а
+# полная перестройка нужна, только если меню меняли другие worker'ы: это видно по версии 'menu'.
+# Подсказки сортируются по популярности - порциям за последние DISH_USAGE_DAYS дней из DailySales.
+DISH_SUGGEST_LIMIT = 8
+DISH_SUGGEST_MAX = 20
+DISH_USAGE_DAYS = 30
+DISH_USAGE_SECONDS = 300 # Как часто перечитывать популярность
+
+def dish_search_key(text):
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+class DishNameIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0.0
+        self.usage_loaded_at = 0.0
+        self.keys = [] # [(ключ, название)] по возрастанию
+        self.categories = {} # название -> {категории}
+        self.usage = {} # название -> порций за DISH_USAGE_DAYS
+        self.stats = {'searches': 0, 'rebuilds': 0, 'inserts': 0}
+
+    def _insert(self, name, category):
+        if name in self.categories:
+            self.categories[name].add(category)
+            return
+        self.categories[name] = {category}
+        words = dish_search_key(name).split(' ')
+        for i in range(len(words)):
+            bisect.insort(self.keys, (' '.join(words[i:]), name))
+
+    def _rebuild(self, version):
+        self.keys, self.categories = [], {}
+        for name, category in dishes_query().with_entities(MenuItem.name, MenuItem.category):
+            self._insert(name, category)
+        self.version = version
+        self.stats['rebuilds'] += 1
+
+    def _load_usage(self):
+        since = date.today() - timedelta(days=DISH_USAGE_DAYS - 1)
+        rows = db.session.query(MenuItem.name, func.sum(DailySales.portions)) \
+            .join(DailySales, DailySales.item_id == MenuItem.id) \
+            .filter(DailySales.day >= since, MenuItem.category.in_(['breakfast', 'lunch'])) \
+            .group_by(MenuItem.name).all()
+        self.usage = {name: int(portions or 0) for name, portions in rows}
+
+    def added(self, name, category, version):
+        # Вызывается после commit в add_dish; version - версия меню, которую вернул menu_changed()
+        with self._lock:
+            if self.version is not None and self.version == version - 1:
+                self._insert(name, category)
+                self.version = version
+                self.stats['inserts'] += 1
+            else:
+                self.checked_at = 0.0 # Пропустили чужие изменения: перестроимся при следующем поиске
+
+    def search(self, prefix, limit=DISH_SUGGEST_LIMIT):
+        ttl = app.config['MENU_CACHE_SECONDS']
+        key = dish_search_key(prefix)
+        with self._lock:
+            now = time.monotonic()
+            if self.version is None or now - self.checked_at >= ttl:
+                version = counter_value('menu')
+                if version != self.version:
+                    self._rebuild(version)
+                self.checked_at = now
+            if now - self.usage_loaded_at >= DISH_USAGE_SECONDS:
+                self._load_usage()
+                self.usage_loaded_at = now
+            self.stats['searches'] += 1
+            matches = set()
+            for i in range(bisect.bisect_left(self.keys, (key,)), len(self.keys)):
+                if not self.keys[i][0].startswith(key):
+                    break
+                matches.add(self.keys[i][1])
+            best = sorted(matches, key=lambda name: (-self.usage.get(name, 0), name.lower()))[:limit]
+            return [{'name': name, 'categories': sorted(self.categories[name]), 'portions': self.usage.get(name, 0)}
+                    for name in best]
+
+dish_name_index = DishNameIndex()
+
+# --- ТЕХКАРТЫ И СПИСАНИЕ ПРОДУКТОВ ---
+# Продажа блюда списывает продукты по техкарте. Расход всех ингредиентов за транзакцию
+# суммируется и применяется одним UPDATE ... SET quantity = CASE id ... END (не ниже нуля),
+# а RETURNING сразу дает новые остатки для проверки "заканчивается".
+LOW_STOCK_THRESHOLD = 5
+
+def deduct_ingredients(portions_by_dish):
+    # portions_by_dish: {id блюда: порций}. Вызывать внутри транзакции продажи.
+    # Возвращает продукты, остаток которых в этой транзакции опустился ниже порога: [(название, остаток)]
+    recipes = db.session.query(RecipeIngredient.dish_id, RecipeIngredient.product_id, RecipeIngredient.amount) \
+        .filter(RecipeIngredient.dish_id.in_(portions_by_dish)).all()
+    deductions = {}
+    for dish_id, product_id, amount in recipes:
+        deductions[product_id] = deductions.get(product_id, 0) + amount * portions_by_dish[dish_id]
+    if not deductions:
+        return []
+
+    deduction = db.case(deductions, value=MenuItem.id)
+    updated = db.session.execute(
+        db.update(MenuItem)
+        .where(MenuItem.id.in_(deductions))
+        .values(quantity=db.case((MenuItem.quantity > deduction, MenuItem.quantity - deduction), else_=0))
+        .returning(MenuItem.id, MenuItem.name, MenuItem.quantity)
+        .execution_options(synchronize_session=False)
+    ).all()
+    # Предупреждаем при пересечении порога (а не при каждой следующей продаже) и когда продукта
+    # не хватило на всю продажу: остаток обнулен, и без пополнения это повторится
+    return [(row.name, row.quantity) for row in updated
+            if row.quantity < LOW_STOCK_THRESHOLD <= row.quantity + deductions[row.id]]
+
+def dish_recipe(dish_id):
+    return db.session.query(RecipeIngredient.product_id, MenuItem.name, RecipeIngredient.amount) \
+        .join(MenuItem, RecipeIngredient.product_id == MenuItem.id) \
+        .filter(RecipeIngredient.dish_id == dish_id).order_by(MenuItem.name).all()
+
+# --- АЛЛЕРГЕНЫ ---
+# Аллергены блюда и аллергии ученика хранятся текстом (для показа) и битовой маской по словарю
+# allergens.py, которая считается при записи (add_dish, update_profile). Блюдо опасно для ученика,
+# если allergen_mask & allergy_mask != 0; отчет по всем ученикам - одна матрица NumPy.
+def allergy_conflicts(items, allergy_mask):
+    # {id блюда: [аллергены ученика в этом блюде]}
+    return {i.id: allergens.names(i.allergen_mask & allergy_mask) for i in items if i.allergen_mask & allergy_mask}
+
+def allergen_safety_report():
+    started = time.perf_counter()
+    students_total = db.session.query(func.count(User.id)).filter(User.role == 'student').scalar()
+    # Ученикам без аллергий подходит все - в матрицу попадают только остальные
+    students = db.session.query(User.id, User.username, User.allergy_mask) \
+        .filter(User.role == 'student', User.allergy_mask != 0).order_by(User.id).all()
+    dishes = dishes_query().filter(MenuItem.is_active == True) \
+        .with_entities(MenuItem.id, MenuItem.name, MenuItem.category, MenuItem.allergen_mask).order_by(MenuItem.id).all()
+    conflicts = allergens.conflict_matrix([s.allergy_mask for s in students], [d.allergen_mask for d in dishes])
+
+    unsafe = conflicts.sum(axis=0)
+    dish_rows = [{'id': d.id, 'name': d.name, 'category': d.category, 'allergens': allergens.names(d.allergen_mask),
+                  'unsafe_students': int(unsafe[j]), 'safe_students': students_total - int(unsafe[j])}
+                 for j, d in enumerate(dishes)]
+    # Ученики, которым в категории не подходит ни одно блюдо
+    no_safe_dish = {}
+    for category in ('breakfast', 'lunch'):
+        columns = [j for j, d in enumerate(dishes) if d.category == category]
+        blocked = conflicts[:, columns].all(axis=1).nonzero()[0] if columns else []
+        no_safe_dish[category] = [{'id': students[i].id, 'username': students[i].username,
+                                   'allergies': allergens.names(students[i].allergy_mask)} for i in blocked]
+    return {
+        'students': students_total,
+        'students_with_allergies': len(students),
+        'allergen_counts': allergens.allergen_counts([s.allergy_mask for s in students]),
+        'dishes': dish_rows,
+        'no_safe_dish': no_safe_dish,
+        'compute_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+
+# --- ПЕРЕМЕНЫ ВЫДАЧИ И ПРЕДЗАКАЗЫ ---
+# Заказ привязан к дню и перемене выдачи. Заказать можно заранее, на PREORDER_DAYS дней вперед,
+# но не раньше даты блюда (MenuItem.date). У перемены есть емкость в порциях: бронь - один
+# INSERT ... ON CONFLICT DO UPDATE ... WHERE booked + n <= capacity, поэтому параллельные покупки
+# не переполнят перемену. Очередь кухни делится по переменам: экран повара читает только текущую
+# перемену вместе с не выданными заказами прошлых.
+def serving_slots():
+    # [(начало, конец)] из SERVING_SLOTS по возрастанию, время в формате 'ЧЧ:ММ'
+    slots = []
+    for part in app.config['SERVING_SLOTS'].split(','):
+        start, _, end = part.strip().partition('-')
+        slots.append(tuple(datetime.strptime(t.strip(), '%H:%M').strftime('%H:%M') for t in (start, end)))
+    return sorted(slots)
+
+def current_slot(now=None):
+    # Перемена, которая идет или будет следующей; после последней - последняя
+    clock = (now or datetime.now()).strftime('%H:%M')
+    slots = serving_slots()
+    for start, end in slots:
+        if end > clock:
+            return start
+    return slots[-1][0]
+
+def bookable_slots(serve_date, now=None):
+    # На сегодня - только не закончившиеся перемены (и текущая, даже если выдача уже идет к концу)
+    now = now or datetime.now()
+    if serve_date > now.date():
+        return [start for start, _ in serving_slots()]
+    clock = now.strftime('%H:%M')
+    return [start for start, end in serving_slots() if end > clock] or [current_slot(now)]
+
+def reserve_slot(serve_date, slot, portions):
+    # Вызывать внутри транзакции покупки. Возвращает, сколько порций осталось в перемене, или None, если мест нет
+    capacity = app.config['SLOT_CAPACITY']
+    if portions > capacity:
+        return None
+    table = ServingSlot.__table__
+    stmt = _upsert(table).values(day=serve_date, slot=slot, capacity=capacity, booked=portions)
+    stmt = stmt.on_conflict_do_update(index_elements=['day', 'slot'], set_={'booked': table.c.booked + portions},
+                                      where=table.c.booked + portions <= table.c.capacity)
+    return db.session.execute(stmt.returning(table.c.capacity - table.c.booked)).scalar()
+
+def slot_partition_filter(serve_date, slot, include_overdue=False):
+    if not include_overdue:
+        return db.and_(Order.serve_date == serve_date, Order.slot == slot)
+    # Текущая перемена и все более ранние (старые заказы без дня и перемены - тоже)
+    return db.or_(Order.serve_date.is_(None), Order.serve_date < serve_date,
+                  db.and_(Order.serve_date == serve_date, db.or_(Order.slot.is_(None), Order.slot <= slot)))
+
+def order_in_partition(payload, serve_date, slot, include_overdue=False):
+    # То же условие, что slot_partition_filter, для событий ленты (payload из order_payload)
+    key = (payload['serve_date'] or '', payload['slot'] or '')
+    target = (serve_date.isoformat(), slot)
+    return key <= target if include_overdue else key == target
+
+def kitchen_partition(args, now=None):
+    # ?date=ГГГГ-ММ-ДД&slot=ЧЧ:ММ - одна перемена; без параметров - текущая вместе с просроченными
+    now = now or datetime.now()
+    if not args.get('date') and not args.get('slot'):
+        return now.date(), current_slot(now), True
+    serve_date = datetime.strptime(args['date'], '%Y-%m-%d').date() if args.get('date') else now.date()
+    slot = args.get('slot') or serving_slots()[0][0]
+    if slot not in dict(serving_slots()):
+        raise ValueError(slot)
+    return serve_date, slot, False
+
+def slot_load(serve_date):
+    # Загрузка перемен дня: бронь / емкость и сколько заказов еще не выдано
+    booked = {row.slot: row for row in ServingSlot.query.filter(ServingSlot.day == serve_date)}
+    waiting = dict(db.session.query(Order.slot, func.count(Order.id))
+                   .filter(open_orders_filter(), Order.serve_date == serve_date).group_by(Order.slot).all())
+    load = []
+    for start, end in serving_slots():
+        row = booked.get(start)
+        capacity = row.capacity if row else app.config['SLOT_CAPACITY']
+        taken = row.booked if row else 0
+        load.append({'slot': start, 'label': f'{start}–{end}', 'capacity': capacity, 'booked': taken,
+                     'left': max(capacity - taken, 0), 'open_orders': waiting.get(start, 0)})
+    return load
+
+# --- ПОКУПКИ ---
+# Остаток и баланс списываются условными UPDATE ... WHERE quantity >= :n прямо в базе, поэтому
+# параллельные покупки (в т.ч. из разных worker'ов) не могут продать больше, чем есть на складе,
+# или увести баланс в минус. Вся покупка - одна транзакция.
+class PurchaseError(Exception):
+    pass
+
+def place_order(user, item_id, quantity, serve_date=None, slot=None):
+    # serve_date / slot - день и перемена выдачи; по умолчанию ближайшие, на которые блюдо доступно
+    if quantity < 1:
+        raise PurchaseError('Некорректное количество порций')
+    item = db.session.query(MenuItem.id, MenuItem.name, MenuItem.price, MenuItem.date).filter(MenuItem.id == item_id).first()
+    if item is None:
+        raise PurchaseError('Недостаточно товара на складе!')
+
+    now = datetime.utcnow()
+    local_now = to_local(now) # День и перемена - по местным часам
+    today = local_now.date()
+    serve_date = serve_date or max(today, item.date or today)
+    if not today <= serve_date <= today + timedelta(days=app.config['PREORDER_DAYS']):
+        raise PurchaseError(f"Заказать можно на сегодня и на {app.config['PREORDER_DAYS']} дн. вперед")
+    if item.date and serve_date < item.date:
+        raise PurchaseError(f"Блюдо {item.name} можно заказать с {item.date.strftime('%d.%m')}")
+    available = bookable_slots(serve_date, local_now)
+    slot = slot or available[0]
+    if slot not in available:
+        raise PurchaseError('Эта перемена уже прошла или не существует')
+
+    total_price = item.price * quantity
+    by_subscription = user.subscription_end is not None and user.subscription_end > now
+    try:
+        remaining = db.session.execute(
+            db.update(MenuItem)
+            .where(MenuItem.id == item.id, MenuItem.is_active == True, MenuItem.quantity >= quantity)
+            .values(quantity=MenuItem.quantity - quantity)
+            .returning(MenuItem.quantity)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if remaining is None:
+            raise PurchaseError('Недостаточно товара на складе!')
+        if reserve_slot(serve_date, slot, quantity) is None:
+            raise PurchaseError(f"На перемену {slot} ({serve_date.strftime('%d.%m')}) мест нет, выберите другую")
+
+        # Если есть подписка, списываем 0 (или можно реализовать логику лимитов)
+        if not by_subscription:
+            debited = db.session.execute(
+                db.update(User)
+                .where(User.id == user.id, User.balance >= total_price)
+                .values(balance=User.balance - total_price)
+                .returning(User.id)
+                .execution_options(synchronize_session=False)
+            ).scalar()
+            if debited is None:
+                raise PurchaseError(f'Недостаточно средств! Стоимость: {total_price} ₽, Баланс: {user.balance} ₽')
+
+        low_products = deduct_ingredients({item.id: quantity})
+
+        payment_status = SUBSCRIPTION_STATUS if by_subscription else "Issued" # Статус "Выдано" (или "Оформлено")
+        record_sale(today, item.id, quantity, 0 if by_subscription else total_price,
+                    sub_portions=quantity if by_subscription else 0,
+                    new_student=is_first_order_today(user.id, now))
+
+        # Один заказ на всю покупку: повар видит одну карточку с количеством порций
+        order = Order(user_id=user.id, item_id=item.id, quantity=quantity, unit_price=item.price,
+                      status=payment_status, timestamp=now, serve_date=serve_date, slot=slot)
+        db.session.add(order)
+        db.session.flush() # Получаем ID заказа до commit, чтобы не перечитывать его после
+        order_feed.publish('order_created', {'orders': [
+            order_payload(order.id, user.username, item.name, quantity, 0, now, payment_status, serve_date, slot)]})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    invalidate_user(user.id) # Изменился баланс
+    return item.name, remaining, low_products, serve_date, slot
 
 # --- МАРШРУТЫ ---
 
@@ -117,8 +1839,14 @@ def register():
         password = request.form['password']
         role = request.form['role'] # Выбор роли (для демо)
 
-        hashed_pw = generate_password_hash(password, method='scrypt')
-        new_user = User(username=username, password_hash=hashed_pw, role=role)
+        try:
+            hashed_pw = hash_password(password)
+        except PasswordHashBusy:
+            flash('Сервер перегружен, попробуйте через несколько секунд.', 'error')
+            return render_template('register.html'), 503
+        # Старые рассылки для роли новому пользователю не показываем как непрочитанные
+        new_user = User(username=username, password_hash=hashed_pw, role=role,
+                        broadcast_read_id=latest_broadcast_id(role))
         
         try:
             db.session.add(new_user)
@@ -137,7 +1865,18 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
 
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            valid = user is not None and verify_password(user.password_hash, password)
+            if valid and password_needs_rehash(user.password_hash):
+                # Параметры хэширования изменились - обновляем хэш, пока знаем пароль
+                user.password_hash = hash_password(password)
+                db.session.commit()
+        except PasswordHashBusy:
+            flash('Сервер перегружен, попробуйте войти через несколько секунд.', 'error')
+            return render_template('login.html'), 503
+
+        if valid:
+            invalidate_user(user.id)
             login_user(user)
             return redirect(url_for('dashboard'))
         else:
@@ -152,8 +1891,8 @@ def dashboard():
     
     # Логика для разных ролей
     if current_user.role == 'student':
-        # Студент видит меню
-        menu_items = MenuItem.query.filter(MenuItem.is_active == True, MenuItem.quantity > 0).all()
+        # Студент видит меню (из кэша, см. MenuCache)
+        _, menu_items = menu_cache.available_items()
         is_subscribed = False
         if current_user.subscription_end and current_user.subscription_end > datetime.utcnow():
             is_subscribed = True
@@ -166,51 +1905,44 @@ def dashboard():
                 # Простая проверка, чтобы не спамить (можно улучшить)
                 if not Notification.query.filter_by(user_id=current_user.id, message=msg).first():
                     notify_user(current_user.id, msg)
-                    db.session.commit()
 
-        # Проверяем, что студент уже заказал сегодня (чтобы не показывать кнопку оплаты повторно)
-        today_start = datetime.combine(today, datetime.min.time())
-        tomorrow_start = today_start + timedelta(days=1)
-        user_orders = Order.query.filter(Order.user_id == current_user.id, Order.timestamp >= today_start, Order.timestamp < tomorrow_start).all()
+        # Проверяем, что студент уже заказал на сегодня (чтобы не показывать кнопку оплаты повторно).
+        # Предзаказ на другой день сюда не попадает; у старых заказов без дня выдачи - день оформления
+        today_start, tomorrow_start = day_start(today), day_start(today + timedelta(days=1))
+        user_orders = db.session.query(Order.item_id).filter(
+            Order.user_id == current_user.id,
+            db.or_(Order.serve_date == today,
+                   db.and_(Order.serve_date.is_(None), Order.timestamp >= today_start, Order.timestamp < tomorrow_start))).all()
         ordered_item_ids = [o.item_id for o in user_orders]
             
-        return render_template('dashboard.html', role='student', menu=menu_items, is_subscribed=is_subscribed, now=now, ordered_item_ids=ordered_item_ids)
+        # Аллергены ученика в блюдах меню - побитовое И масок
+        conflicts = allergy_conflicts(menu_items, current_user.allergy_mask or 0)
+
+        # Дни для предзаказа и перемены выдачи (формы покупки)
+        order_days = [today + timedelta(days=i) for i in range(app.config['PREORDER_DAYS'] + 1)]
+        return render_template('dashboard.html', role='student', menu=menu_items, is_subscribed=is_subscribed, now=now, ordered_item_ids=ordered_item_ids,
+                               order_days=order_days, slots=serving_slots(), current_slot=current_slot(), allergy_conflicts=conflicts)
     
     elif current_user.role == 'cook':
-        # Повар видит управление меню и остатками
-        # Разделяем склад на Продукты (сырье) и Готовые блюда
-        warehouse_products = MenuItem.query.filter_by(category='product').all()
-        
-        # Разделяем блюда на Черновики (Склад) и Активные (Выдача)
-        draft_dishes = MenuItem.query.filter(MenuItem.category.in_(['breakfast', 'lunch']), MenuItem.is_active == False).order_by(MenuItem.date.desc()).all()
-        active_dishes = MenuItem.query.filter(MenuItem.category.in_(['breakfast', 'lunch']), MenuItem.is_active == True).order_by(MenuItem.quantity.desc()).all()
-        
-        pending_orders = Order.query.filter((Order.status.like('Paid%')) | (Order.status.like('Issued%'))).order_by(Order.timestamp).all()
-        requests = SupplyRequest.query.order_by(SupplyRequest.created_at.desc()).all()
-        
-        # Получаем список уникальных названий блюд для автоподстановки
-        dish_names = [r[0] for r in db.session.query(MenuItem.name).filter(MenuItem.category.in_(['breakfast', 'lunch'])).distinct().all()]
-        
-        return render_template('dashboard.html', role='cook', 
-                               products=warehouse_products, 
-                               draft_dishes=draft_dishes,
-                               active_dishes=active_dishes,
-                               orders=pending_orders, 
-                               requests=requests, now=now,
-                               dish_names=dish_names)
+        # Повар получает только оболочку страницы: вкладки (меню, склад, закупки) подгружаются
+        # через /api/cook/tabs/<вкладка> при открытии, очередь заказов - через /api/orders/stream
+        return render_template('dashboard.html', role='cook', now=now)
     
     elif current_user.role == 'admin':
         # Админ видит статистику
-        today_start = datetime.combine(today, datetime.min.time())
         month_start = today.replace(day=1)
         
-        # 1. Финансы
-        revenue_today = db.session.query(func.sum(MenuItem.price)).join(Order).filter(Order.timestamp >= today_start, Order.status != 'Issued (Sub)').scalar() or 0
-        revenue_month = db.session.query(func.sum(MenuItem.price)).join(Order).filter(Order.timestamp >= month_start, Order.status != 'Issued (Sub)').scalar() or 0
+        # 1. Финансы (месяц и график за 7 дней - одним запросом)
+        chart_start = today - timedelta(days=6)
+        revenue_by_day = daily_revenue(min(month_start, chart_start), today)
+        revenue_today = revenue_by_day.get(today, 0)
+        revenue_month = sum(total for d, total in revenue_by_day.items() if d >= month_start)
         
-        # 2. Посещаемость
-        portions_sold = Order.query.filter(Order.timestamp >= today_start).count()
-        unique_students = db.session.query(func.count(func.distinct(Order.user_id))).filter(Order.timestamp >= today_start).scalar() or 0
+        # 2. Посещаемость (из сводки продаж за сегодня)
+        portions_sold, unique_students = db.session.query(func.sum(DailySales.portions), func.sum(DailySales.new_students)) \
+            .filter(DailySales.day == today).one()
+        portions_sold = portions_sold or 0
+        unique_students = unique_students or 0
         total_students = User.query.filter_by(role='student').count()
         
         # 3. Данные для блоков
@@ -218,18 +1950,12 @@ def dashboard():
         dishes = MenuItem.query.filter(MenuItem.category.in_(['breakfast', 'lunch'])).all()
         pending_requests = SupplyRequest.query.filter_by(status='Pending').order_by(SupplyRequest.created_at.desc()).all()
         
-        # 4. Отзывы с сортировкой
+        # 4. Отзывы с сортировкой: только первая страница, остальные подгружаются через /api/reviews
         sort_by = request.args.get('sort', 'newest')
-        reviews_query = Review.query
-        if sort_by == 'newest':
-            reviews_query = reviews_query.order_by(Review.timestamp.desc())
-        elif sort_by == 'oldest':
-            reviews_query = reviews_query.order_by(Review.timestamp.asc())
-        elif sort_by == 'rating_high':
-            reviews_query = reviews_query.order_by(Review.rating.desc())
-        elif sort_by == 'rating_low':
-            reviews_query = reviews_query.order_by(Review.rating.asc())
-        reviews = reviews_query.all()
+        if sort_by not in REVIEW_SORTS:
+            sort_by = 'newest'
+        reviews, reviews_cursor = review_page(sort_by)
+        rating_summary = review_summary()
         
         stats = {'revenue_today': revenue_today, 'revenue_month': revenue_month, 
                  'portions_sold': portions_sold, 'unique_students': unique_students, 'total_students': total_students}
@@ -239,13 +1965,10 @@ def dashboard():
         chart_data = []
         for i in range(6, -1, -1):
             d = today - timedelta(days=i)
-            d_start = datetime.combine(d, datetime.min.time())
-            d_end = d_start + timedelta(days=1)
-            day_rev = db.session.query(func.sum(MenuItem.price)).join(Order).filter(Order.timestamp >= d_start, Order.timestamp < d_end, Order.status != 'Issued (Sub)').scalar() or 0
             chart_labels.append(d.strftime('%d.%m'))
-            chart_data.append(day_rev)
+            chart_data.append(revenue_by_day.get(d, 0))
         
-        return render_template('dashboard.html', role='admin', stats=stats, products=products, dishes=dishes, requests=pending_requests, reviews=reviews, now=now, chart_labels=chart_labels, chart_data=chart_data, sort_by=sort_by)
+        return render_template('dashboard.html', role='admin', stats=stats, products=products, dishes=dishes, requests=pending_requests, reviews=reviews, reviews_cursor=reviews_cursor, rating_summary=rating_summary, now=now, chart_labels=chart_labels, chart_data=chart_data, sort_by=sort_by)
 
 @app.route('/add_dish', methods=['POST'])
 @login_required
@@ -257,7 +1980,8 @@ def add_dish():
     price = float(request.form['price'])
     category = request.form['category']
     qty = int(request.form['quantity'])
-    allergens = request.form.get('allergens', '')
+    allergen_text = request.form.get('allergens', '')
+    allergen_mask, unknown = allergens.parse(allergen_text)
     
     # Обработка даты
     date_str = request.form.get('date')
@@ -265,25 +1989,21 @@ def add_dish():
     if date_str:
         menu_date = datetime.strptime(date_str, '%Y-%m-%d').date()
     
-    # Проверяем, существует ли уже такое блюдо
-    existing_item = MenuItem.query.filter_by(name=name, category=category).first()
-    
-    if existing_item:
-        # Обновляем существующее блюдо
-        existing_item.price = price
-        existing_item.quantity += qty # Добавляем к текущему остатку
-        existing_item.date = menu_date
-        existing_item.allergens = allergens
-        
-        # Если блюдо уже активно, оставляем его активным (пополнение меню)
-        # Если было неактивно (черновик или закончилось), то оставляем False (требует публикации)
-        if not existing_item.is_active:
-            existing_item.is_active = False 
-    else:
-        new_item = MenuItem(name=name, price=price, category=category, quantity=qty, date=menu_date, allergens=allergens, is_active=False)
-        db.session.add(new_item)
+    # Новое блюдо создается черновиком; существующее (уникальный индекс name+category) обновляется
+    # и пополняется одним запросом. Статус публикации при пополнении не меняется.
+    table = MenuItem.__table__
+    stmt = _upsert(table).values(name=name, price=price, category=category, quantity=qty, date=menu_date,
+                                 allergens=allergen_text, allergen_mask=allergen_mask, is_active=False)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['name', 'category'],
+        set_={'price': price, 'quantity': func.coalesce(table.c.quantity, 0) + qty, 'date': menu_date,
+              'allergens': allergen_text, 'allergen_mask': allergen_mask}))
         
+    version = menu_changed()
     db.session.commit()
+    dish_name_index.added(name, category, version)
+    if unknown:
+        flash(f"Не распознаны аллергены: {', '.join(unknown)}. Ученики не получат по ним предупреждение.", 'error')
     return redirect(url_for('dashboard'))
 
 @app.route('/buy/<int:item_id>')
@@ -292,42 +2012,30 @@ def buy(item_id):
     if current_user.role != 'student':
         return redirect(url_for('dashboard'))
     
-    quantity = int(request.args.get('quantity', 1))
-    item = MenuItem.query.get(item_id)
+    quantity = request.args.get('quantity', 1, type=int)
+    try:
+        serve_date = datetime.strptime(request.args['serve_date'], '%Y-%m-%d').date() if request.args.get('serve_date') else None
+    except ValueError:
+        flash('Некорректная дата заказа', 'error')
+        return redirect(url_for('dashboard'))
+    try:
+        item_name, remaining, low_products, serve_date, slot = place_order(
+            current_user, item_id, quantity, serve_date, request.args.get('slot') or None)
+    except PurchaseError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('dashboard'))
+
+    when = f"{serve_date.strftime('%d.%m')}, перемена {slot}"
+    flash(f'Блюдо {item_name} ({quantity} шт.) оформлено на {when}!', 'success')
     
-    if item and item.is_active and item.quantity is not None and item.quantity >= quantity:
-        item.quantity -= quantity # Списываем со склада
-        total_price = item.price * quantity
-        
-        # Проверка абонемента
-        payment_status = "Issued" # Статус "Выдано" (или "Оформлено")
-        if current_user.subscription_end and current_user.subscription_end > datetime.utcnow():
-            payment_status = "Issued (Sub)"
-            # Если есть подписка, списываем 0 (или можно реализовать логику лимитов)
-        else:
-            # Если подписки нет, списываем с баланса
-            if current_user.balance < total_price:
-                flash(f'Недостаточно средств! Стоимость: {total_price} ₽, Баланс: {current_user.balance} ₽', 'error')
-                return redirect(url_for('dashboard'))
-            current_user.balance -= total_price
-            
-        # Создаем заказ на каждую порцию (или можно изменить модель Order для хранения quantity)
-        # Для простоты создаем N записей заказа, чтобы повар видел N карточек
-        for _ in range(quantity):
-            order = Order(user_id=current_user.id, item_id=item.id, status=payment_status, timestamp=datetime.utcnow())
-            db.session.add(order)
-            
-        db.session.commit()
-        flash(f'Блюдо {item.name} ({quantity} шт.) оформлено!', 'success')
-        
-        # Уведомление поварам о новом заказе
-        notify_role('cook', f"Поступил новый заказ: {item.name} ({quantity} шт.)")
-        
-        # Проверка критического остатка
-        if item.quantity < 5:
-            notify_role('cook', f"Внимание! Заканчивается {item.name}. Осталось всего {item.quantity} порций")
-    else:
-        flash('Недостаточно товара на складе!', 'error')
+    # Уведомление поварам о новом заказе
+    notify_role('cook', f"Поступил новый заказ: {item_name} ({quantity} шт.) на {when}")
+    
+    # Проверка критического остатка: блюдо и продукты по техкарте - одним уведомлением
+    low_stock = [f"{item_name} ({remaining} порц.)"] if remaining < LOW_STOCK_THRESHOLD else []
+    low_stock += [f"{name} ({left})" for name, left in low_products]
+    if low_stock:
+        notify_role('cook', f"Внимание! Заканчивается: {', '.join(low_stock)}")
     return redirect(url_for('dashboard'))
 
 @app.route('/buy_subscription', methods=['POST'])
@@ -337,21 +2045,32 @@ def buy_subscription():
         return redirect(url_for('dashboard'))
     
     price = 1499
-    if current_user.balance >= price:
-        current_user.balance -= price
+    # Списание тем же условным UPDATE, что и в place_order: баланс не уйдет в минус при параллельных запросах
+    debited = db.session.execute(
+        db.update(User)
+        .where(User.id == current_user.id, User.balance >= price)
+        .values(balance=User.balance - price)
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if debited is not None:
         # Логика покупки абонемента (упрощенно продлеваем на 30 дней)
         current_user.subscription_end = datetime.utcnow() + timedelta(days=30)
         
-        # Учитываем в финансах через скрытый товар
-        sub_item = MenuItem.query.filter_by(name='Абонемент (30 дней)').first()
-        if not sub_item:
-            sub_item = MenuItem(name='Абонемент (30 дней)', price=price, category='service', quantity=999999, is_active=False)
-            db.session.add(sub_item)
-            db.session.commit() # Чтобы получить ID
+        # Учитываем в финансах через скрытый товар. Первые параллельные покупки не создадут его дважды:
+        # INSERT ... ON CONFLICT DO NOTHING по уникальному индексу name+category, затем id читается заново
+        sub_name = 'Абонемент (30 дней)'
+        db.session.execute(_upsert(MenuItem.__table__).values(
+            name=sub_name, price=price, category='service', quantity=999999, is_active=False
+        ).on_conflict_do_nothing(index_elements=['name', 'category']))
+        sub_item_id = db.session.query(MenuItem.id).filter_by(name=sub_name, category='service').scalar()
             
-        order = Order(user_id=current_user.id, item_id=sub_item.id, status='Paid (Subscription)', timestamp=datetime.utcnow())
+        now = datetime.utcnow()
+        record_sale(to_local(now).date(), sub_item_id, 1, price, new_student=is_first_order_today(current_user.id, now))
+        order = Order(user_id=current_user.id, item_id=sub_item_id, unit_price=price, status='Paid (Subscription)', timestamp=now)
         db.session.add(order)
         db.session.commit()
+        invalidate_user(current_user.id)
         flash('Абонемент успешно оформлен на 30 дней!', 'success')
     else:
         flash(f'Недостаточно средств. Стоимость: {price} ₽', 'error')
@@ -364,8 +2083,15 @@ def top_up():
     try:
         amount = float(request.form.get('amount'))
         if amount > 0:
-            current_user.balance += amount
+            # Атомарное пополнение: не затирает параллельное списание в place_order
+            db.session.execute(
+                db.update(User)
+                .where(User.id == current_user.id)
+                .values(balance=User.balance + amount)
+                .execution_options(synchronize_session=False)
+            )
             db.session.commit()
+            invalidate_user(current_user.id)
             flash(f'Баланс пополнен на {amount} ₽', 'success')
     except ValueError:
         flash('Некорректная сумма', 'error')
@@ -375,10 +2101,14 @@ def top_up():
 @login_required
 def update_profile():
     if request.method == 'POST':
-        allergies = request.form.get('allergies')
+        allergies = request.form.get('allergies', '')
         current_user.allergies = allergies
+        current_user.allergy_mask, unknown = allergens.parse(allergies)
         db.session.commit()
+        invalidate_user(current_user.id)
         flash('Данные о здоровье обновлены.', 'success')
+        if unknown:
+            flash(f"Не распознано: {', '.join(unknown)}. Предупредите повара лично - автоматически эти аллергии не проверяются.", 'error')
     return redirect(url_for('dashboard'))
 
 @app.route('/add_review/<int:item_id>', methods=['POST'])
@@ -389,6 +2119,7 @@ def add_review(item_id):
     new_review = Review(user_id=current_user.id, item_id=item_id, rating=rating, comment=comment)
     db.session.add(new_review)
     db.session.commit()
+    menu_cache.invalidate_reviews()
     notify_role('admin', f"Поступил новый отзыв от ученика (Оценка: {rating}/5). Проверьте вкладку отзывов")
     flash('Спасибо за отзыв!', 'success')
     return redirect(url_for('dashboard'))
@@ -399,9 +2130,17 @@ def change_password():
     old_password = request.form.get('old_password')
     new_password = request.form.get('new_password')
     
-    if check_password_hash(current_user.password_hash, old_password):
-        current_user.password_hash = generate_password_hash(new_password, method='scrypt')
+    try:
+        valid = verify_password(current_user.password_hash, old_password)
+        if valid:
+            current_user.password_hash = hash_password(new_password)
+    except PasswordHashBusy:
+        flash('Сервер перегружен, попробуйте еще раз через несколько секунд.', 'error')
+        return redirect(url_for('dashboard'))
+
+    if valid:
         db.session.commit()
+        invalidate_user(current_user.id)
         flash('Пароль успешно изменен.', 'success')
     else:
         flash('Старый пароль введен неверно.', 'error')
@@ -414,67 +2153,235 @@ def change_password():
 def get_orders():
     if current_user.role != 'cook':
         return jsonify({'error': 'Unauthorized'}), 403
-    
-    # Получаем все активные заказы (Оплаченные или Оформленные, но не Выполненные)
-    orders = Order.query.filter((Order.status.like('Paid%')) | (Order.status.like('Issued%'))).order_by(Order.timestamp).all()
-    
-    orders_data = []
-    for order in orders:
-        orders_data.append({
-            'id': order.id,
-            'username': order.user.username,
-            'item_name': order.item.name,
-            'timestamp': order.timestamp.strftime('%H:%M'),
-            'status': order.status
-        })
-    return jsonify(orders_data)
+    try:
+        partition = kitchen_partition(request.args)
+    except ValueError:
+        return jsonify({'error': 'Некорректная перемена'}), 400
+    return jsonify(open_orders_data(partition))
+
+@app.route('/api/reports/allergen_safety')
+@login_required
+def allergen_safety_api():
+    # Какие активные блюда безопасны для скольких учеников и кому в категории нечего есть
+    if current_user.role not in ('admin', 'cook'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(allergen_safety_report())
+
+@app.route('/api/slots')
+@login_required
+def slots_api():
+    # Перемены дня (?date=ГГГГ-ММ-ДД, по умолчанию сегодня) с бронью и очередью
+    try:
+        serve_date = datetime.strptime(request.args['date'], '%Y-%m-%d').date() if request.args.get('date') else date.today()
+    except ValueError:
+        return jsonify({'error': 'Некорректная дата'}), 400
+    current = current_slot() if serve_date == date.today() else None
+    return jsonify({'date': serve_date.isoformat(), 'current': current, 'slots': slot_load(serve_date)})
+
+@app.route('/api/cook/tabs/<tab>')
+@login_required
+def cook_tab(tab):
+    if current_user.role != 'cook':
+        return jsonify({'error': 'Unauthorized'}), 403
+    if tab == 'requests':
+        # История заявок: первая страница заменяет таблицу, следующие (?cursor=) дописываются в конец
+        cursor = request.args.get('cursor')
+        try:
+            rows, next_cursor = supply_request_page(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'fragments': {'cook-requests-body': cook_fragment('supply_request_rows', rows)},
+                        'append': bool(cursor), 'next_cursor': next_cursor})
+    fragments = cook_tab_fragments(tab)
+    if fragments is None:
+        return jsonify({'error': 'Неизвестная вкладка'}), 404
+    return jsonify({'fragments': fragments, 'append': False})
+
+@app.route('/api/dishes/autocomplete')
+@login_required
+def dish_autocomplete():
+    if current_user.role != 'cook':
+        return jsonify({'error': 'Unauthorized'}), 403
+    prefix = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', DISH_SUGGEST_LIMIT, type=int), 1), DISH_SUGGEST_MAX)
+    if not prefix:
+        return jsonify({'items': []})
+    return jsonify({'items': dish_name_index.search(prefix, limit)})
+
+@app.route('/api/orders/stream')
+@login_required
+def order_stream():
+    if current_user.role != 'cook':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Перемена - как в /api/get_orders; новые заказы других перемен в поток не попадают
+    try:
+        partition = kitchen_partition(request.args)
+    except ValueError:
+        return jsonify({'error': 'Некорректная перемена'}), 400
+
+    # Sync-worker gunicorn'а держал бы поток целиком: отдаем снимок и просим браузер переподключиться
+    if not request.environ.get('wsgi.multithread'):
+        response = app.response_class(
+            f'retry: {ORDER_STREAM_RETRY_MS}\n' + sse_message('snapshot', {'orders': open_orders_data(partition)}),
+            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    # Подписываемся до чтения снимка, чтобы не потерять заказы, созданные между ними
+    q = order_feed.subscribe()
+    snapshot = open_orders_data(partition)
+
+    def generate():
+        current = partition
+        yield sse_message('snapshot', {'orders': snapshot})
+        started = datetime.utcnow()
+        while (datetime.utcnow() - started).total_seconds() < ORDER_STREAM_MAX_AGE:
+            try:
+                event, data = q.get(timeout=ORDER_STREAM_HEARTBEAT)
+            except queue.Empty:
+                event = None
+            # Поток текущей перемены пересчитывает ее на каждом событии и keep-alive: когда перемена
+            # сменилась, клиент перечитывает очередь (в ней предзаказы новой перемены, созданные раньше)
+            if partition[2]:
+                fresh = kitchen_partition({})
+                if fresh != current:
+                    current = fresh
+                    yield sse_message('resync', {})
+                    continue
+            if event is None:
+                yield ': ping\n\n'
+                continue
+            if event == 'order_created':
+                data = {'orders': [o for o in data['orders'] if order_in_partition(o, *current)]}
+                if not data['orders']:
+                    continue
+            yield sse_message(event, data)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Отключаем буферизацию на прокси (nginx/Render)
+    response.call_on_close(lambda: order_feed.unsubscribe(q))
+    return response
 
 @app.route('/complete_order/<int:order_id>', methods=['POST'])
 @login_required
 def complete_order(order_id):
     if current_user.role != 'cook': return jsonify({'error': 'Unauthorized'}), 403
-    order = Order.query.get(order_id)
-    if order:
-        order.status = 'Completed'
-        db.session.commit()
-        notify_user(order.user_id, f"Ваш заказ '{order.item.name}' готов к выдаче!")
-        return jsonify({'success': True})
-    return jsonify({'error': 'Order not found'}), 404
+    # Условный UPDATE: повторный клик или параллельный complete_all_orders не уведомят ученика второй раз
+    order = db.session.execute(
+        db.update(Order)
+        .where(Order.id == order_id, Order.state == ORDER_OPEN)
+        .values(state=ORDER_COMPLETED, issued=Order.quantity)
+        .returning(Order.user_id, Order.item_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    order_feed.publish('order_completed', {'ids': [order_id]})
+    db.session.commit()
+    notify_user(order.user_id, f"Ваш заказ '{db.session.get(MenuItem, order.item_id).name}' готов к выдаче!")
+    return jsonify({'success': True})
+
+@app.route('/issue_portion/<int:order_id>', methods=['POST'])
+@login_required
+def issue_portion(order_id):
+    # Выдача одной порции из заказа на несколько порций
+    if current_user.role != 'cook': return jsonify({'error': 'Unauthorized'}), 403
+    # Условный UPDATE: два повара, выдающие одновременно, не теряют порцию и не выдают больше заказанного
+    order = db.session.execute(
+        db.update(Order)
+        .where(Order.id == order_id, Order.state == ORDER_OPEN, Order.issued < Order.quantity)
+        .values(issued=Order.issued + 1,
+                state=db.case((Order.issued + 1 >= Order.quantity, ORDER_COMPLETED), else_=ORDER_OPEN))
+        .returning(Order.user_id, Order.item_id, Order.issued, Order.quantity)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+
+    completed = order.issued >= order.quantity
+    if completed:
+        order_feed.publish('order_completed', {'ids': [order_id]})
+    else:
+        order_feed.publish('order_updated', {'orders': [{'id': order_id, 'issued': order.issued, 'quantity': order.quantity}]})
+    db.session.commit()
+    if completed:
+        notify_user(order.user_id, f"Ваш заказ '{db.session.get(MenuItem, order.item_id).name}' готов к выдаче!")
+    return jsonify({'success': True, 'issued': order.issued, 'quantity': order.quantity, 'completed': completed})
 
 @app.route('/complete_all_orders', methods=['POST'])
 @login_required
 def complete_all_orders():
     if current_user.role != 'cook': return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        partition = kitchen_partition(request.args)
+    except ValueError:
+        return jsonify({'error': 'Некорректная перемена'}), 400
     
-    orders = Order.query.filter((Order.status.like('Paid%')) | (Order.status.like('Issued%'))).all()
-    for order in orders:
-        order.status = 'Completed'
+    # Один UPDATE по открытым заказам выбранной перемены; RETURNING отдает, кого уведомлять
+    completed = db.session.execute(
+        db.update(Order)
+        .where(open_orders_filter(), slot_partition_filter(*partition))
+        .values(issued=Order.quantity, state=ORDER_COMPLETED)
+        .returning(Order.id, Order.user_id, Order.item_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not completed:
+        db.session.commit()
+        return jsonify({'success': True, 'completed': 0})
+    order_feed.publish('order_completed', {'ids': [row.id for row in completed]})
     db.session.commit()
-    # В идеале уведомлять каждого пользователя, но для массовой операции можно упростить или в цикле
-    return jsonify({'success': True})
+
+    names = dict(db.session.query(MenuItem.id, MenuItem.name)
+                 .filter(MenuItem.id.in_({row.item_id for row in completed})).all())
+    dishes_by_user = {}
+    for row in completed:
+        dishes = dishes_by_user.setdefault(row.user_id, [])
+        if names.get(row.item_id) not in dishes:
+            dishes.append(names.get(row.item_id))
+    notify_users([(user_id, f"Ваш заказ '{dishes[0]}' готов к выдаче!" if len(dishes) == 1
+                   else f"Ваши заказы ({', '.join(dishes)}) готовы к выдаче!")
+                  for user_id, dishes in dishes_by_user.items()])
+    return jsonify({'success': True, 'completed': len(completed)})
 
 @app.route('/api/get_notifications')
 @login_required
 def get_notifications():
-    # Получаем последние 10 уведомлений (сначала непрочитанные, потом новые)
-    notifications = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.is_read.asc(), Notification.created_at.desc()).limit(10).all()
-    unread_count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
-    
+    # Если у клиента актуальная версия - 304 без обращения к таблице уведомлений
+    etag, watermark = notification_state(current_user.id)
+    if request.if_none_match.contains(etag):
+        return notifications_not_modified(etag)
+
+    # Получаем последние 10 уведомлений (сначала непрочитанные, потом новые): личные и рассылки для роли
+    rows, unread_count = notification_feed(current_user.id, current_user.role, watermark)
     data = [{
         'id': n.id,
+        'kind': n.kind,
         'message': n.message,
-        'is_read': n.is_read,
+        'is_read': bool(n.is_read),
         'created_at': n.created_at.strftime('%H:%M %d.%m')
-    } for n in notifications]
+    } for n in rows]
     
-    return jsonify({'count': unread_count, 'notifications': data})
+    response = jsonify({'count': unread_count, 'notifications': data})
+    return with_notification_etag(response, etag)
+
+@app.route('/api/notifications/count')
+@login_required
+def notification_count():
+    etag, watermark = notification_state(current_user.id)
+    if request.if_none_match.contains(etag):
+        return notifications_not_modified(etag)
+    _, unread_count = notification_feed(current_user.id, current_user.role, watermark, limit=1)
+    return with_notification_etag(jsonify({'count': unread_count}), etag)
 
 @app.route('/api/mark_notifications_read', methods=['POST'])
 @login_required
 def mark_notifications_read():
-    unread = Notification.query.filter_by(user_id=current_user.id, is_read=False).all()
-    for n in unread:
-        n.is_read = True
+    # Личные - одним UPDATE, рассылки - сдвигом отметки прочитанного до последней
+    Notification.query.filter_by(user_id=current_user.id, is_read=False).update({'is_read': True}, synchronize_session=False)
+    current_user.broadcast_read_id = latest_broadcast_id(current_user.role)
+    current_user.notif_version = User.notif_version + 1
     db.session.commit()
     return jsonify({'success': True})
 
@@ -493,14 +2400,96 @@ def update_stock(item_id):
             item.quantity = int(request.form.get('quantity'))
             
         db.session.commit()
+        # Остатки блюд читаются отдельно от снимка меню: версию не меняем, только перечитываем их на этом worker'е
+        if item.category in ('breakfast', 'lunch'):
+            menu_cache.invalidate()
         
-        if item.quantity < 5:
+        if item.quantity < LOW_STOCK_THRESHOLD:
              notify_role('cook', f"Внимание! Заканчивается {item.name}. Осталось всего {item.quantity} порций")
 
         if request.is_json: return jsonify({'success': True})
         
     return redirect(url_for('dashboard'))
 
+@app.route('/api/menu/bulk_update', methods=['POST'])
+@login_required
+def bulk_update_menu():
+    # Утренняя настройка меню одним запросом: {"items": [{"id": 1, "quantity": 30, "is_active": true}, ...]}
+    # Поля quantity и is_active необязательны. Все изменения - одна транзакция.
+    if current_user.role != 'cook': return jsonify({'error': 'Unauthorized'}), 403
+    payload = request.get_json(silent=True) or {}
+    changes = {}
+    try:
+        for entry in payload.get('items') or []:
+            change = changes.setdefault(int(entry['id']), {'id': int(entry['id'])})
+            if entry.get('quantity') is not None:
+                change['quantity'] = int(entry['quantity'])
+                if change['quantity'] < 0:
+                    raise ValueError
+            if entry.get('is_active') is not None:
+                change['is_active'] = bool(entry['is_active'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Некорректные данные'}), 400
+    changes = {item_id: change for item_id, change in changes.items() if len(change) > 1}
+    if not changes:
+        return jsonify({'error': 'Нет изменений'}), 400
+
+    before = {row.id: row for row in db.session.query(MenuItem.id, MenuItem.name, MenuItem.quantity, MenuItem.is_active,
+                                                       MenuItem.category)
+              .filter(MenuItem.id.in_(changes)).all()}
+    missing = sorted(set(changes) - set(before))
+    if missing:
+        return jsonify({'error': 'Позиции не найдены', 'missing': missing}), 404
+    # Только блюда меню: продукты склада и служебные позиции (абонемент) этим запросом не меняются
+    not_dishes = sorted(i for i, row in before.items() if row.category not in ('breakfast', 'lunch'))
+    if not_dishes:
+        return jsonify({'error': 'Можно менять только блюда меню', 'not_dishes': not_dishes}), 400
+
+    # UPDATE по первичному ключу через executemany (строки группируются по набору полей)
+    db.session.execute(db.update(MenuItem), list(changes.values()))
+    menu_changed()
+    db.session.commit()
+
+    published = [before[i].name for i, c in changes.items() if c.get('is_active') and not before[i].is_active]
+    low_stock = [f"{before[i].name} ({c['quantity']})" for i, c in changes.items() if c.get('quantity', LOW_STOCK_THRESHOLD) < LOW_STOCK_THRESHOLD]
+    if published:
+        notify_role('student', f"Меню обновлено! Теперь доступны для заказа: {', '.join(published)}")
+    if low_stock:
+        notify_role('cook', f"Внимание! Заканчиваются: {', '.join(low_stock)}")
+    return jsonify({'success': True, 'updated': len(changes), 'published': len(published)})
+
+@app.route('/api/recipes/<int:dish_id>', methods=['GET', 'PUT'])
+@login_required
+def recipe_api(dish_id):
+    # Техкарта блюда. PUT заменяет ее целиком: {"ingredients": [{"product_id": 3, "amount": 2}, ...]}
+    if current_user.role != 'cook': return jsonify({'error': 'Unauthorized'}), 403
+    dish = db.session.get(MenuItem, dish_id)
+    if dish is None or dish.category == 'product':
+        return jsonify({'error': 'Блюдо не найдено'}), 404
+
+    if request.method == 'PUT':
+        payload = request.get_json(silent=True) or {}
+        try:
+            ingredients = {int(i['product_id']): int(i['amount']) for i in payload.get('ingredients') or []}
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Некорректные данные'}), 400
+        if any(amount <= 0 for amount in ingredients.values()):
+            return jsonify({'error': 'Количество продукта должно быть больше нуля'}), 400
+        products = {pid for (pid,) in db.session.query(MenuItem.id)
+                    .filter(MenuItem.id.in_(ingredients), MenuItem.category == 'product')}
+        missing = sorted(set(ingredients) - products)
+        if missing:
+            return jsonify({'error': 'Продукты не найдены', 'missing': missing}), 404
+
+        db.session.query(RecipeIngredient).filter(RecipeIngredient.dish_id == dish_id).delete(synchronize_session=False)
+        if ingredients:
+            db.session.execute(RecipeIngredient.__table__.insert(), [
+                {'dish_id': dish_id, 'product_id': pid, 'amount': amount} for pid, amount in ingredients.items()])
+        db.session.commit()
+
+    return jsonify({'dish_id': dish_id, 'name': dish.name, 'ingredients': [
+        {'product_id': pid, 'name': name, 'amount': amount} for pid, name, amount in dish_recipe(dish_id)]})
+
 @app.route('/create_request', methods=['POST'])
 @login_required
 def create_request():
@@ -520,33 +2509,49 @@ def create_request():
 @login_required
 def auto_request():
     if current_user.role != 'cook': return redirect(url_for('dashboard'))
-    low_stock = MenuItem.query.filter(MenuItem.quantity < 5).all()
-    for item in low_stock:
-        req = SupplyRequest(product_name=item.name, quantity=50, priority='Urgent')
-        db.session.add(req)
+    plan = supply_forecast()
+    if not plan:
+        flash('Запасов хватает, новые заявки не нужны.', 'success')
+        return redirect(url_for('dashboard'))
+    db.session.execute(SupplyRequest.__table__.insert(), [
+        {'product_name': p['name'], 'quantity': p['quantity'], 'priority': p['priority'],
+         'status': 'Pending', 'total_cost': 0.0, 'created_at': datetime.utcnow()} for p in plan])
     db.session.commit()
-    notify_role('admin', f"Повар сформировал {len(low_stock)} авто-заявок на закупку")
-    flash(f'Сформировано {len(low_stock)} заявок.', 'success')
+    notify_role('admin', f"Повар сформировал {len(plan)} авто-заявок на закупку")
+    flash(f'Сформировано {len(plan)} заявок.', 'success')
     return redirect(url_for('dashboard'))
 
+@app.route('/api/supply_forecast')
+@login_required
+def supply_forecast_api():
+    # Предпросмотр автозаявок без их создания
+    if current_user.role not in ('cook', 'admin'):
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'items': supply_forecast()})
+
 @app.route('/approve_request/<int:req_id>', methods=['POST'])
 @login_required
 def approve_request(req_id):
     if current_user.role != 'admin': return redirect(url_for('dashboard'))
     
-    req = SupplyRequest.query.get(req_id)
-    if req and req.status == 'Pending':
+    # Условный UPDATE: заявку, которую параллельно одобрил или отклонил другой администратор, не проводим второй раз
+    req = db.session.execute(
+        db.update(SupplyRequest)
+        .where(SupplyRequest.id == req_id, SupplyRequest.status == 'Pending')
+        .values(status='Approved')
+        .returning(SupplyRequest.product_name, SupplyRequest.quantity)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if req:
         try:
-            req.status = 'Approved'
-            
-            # Логика переноса на склад (Продукты)
-            product = MenuItem.query.filter_by(name=req.product_name, category='product').first()
-            if product:
-                product.quantity += req.quantity
-            else:
-                # Создаем новый продукт (цена 0, так как это сырье)
-                new_prod = MenuItem(name=req.product_name, price=0, category='product', quantity=req.quantity, is_active=False)
-                db.session.add(new_prod)
+            # Логика переноса на склад (Продукты): новый продукт создается (цена 0, так как это сырье),
+            # у существующего остаток увеличивается в SQL и не затирает параллельное списание deduct_ingredients
+            table = MenuItem.__table__
+            stmt = _upsert(table).values(name=req.product_name, price=0, category='product', quantity=req.quantity,
+                                         is_active=False)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['name', 'category'],
+                set_={'quantity': func.coalesce(table.c.quantity, 0) + req.quantity}))
                 
             db.session.commit()
             flash(f'Заявка на {req.product_name} одобрена и добавлена на склад.', 'success')
@@ -575,29 +2580,51 @@ def reject_request(req_id):
 def download_report():
     if current_user.role != 'admin': return redirect(url_for('dashboard'))
     
-    # Генерация CSV отчета за последние 30 дней
+    # Генерация CSV отчета (по умолчанию за последние 30 дней, период задается ?days= или ?start=&end=)
+    try:
+        start_day, end_day = report_period(request.args)
+    except ValueError:
+        flash('Некорректный период отчета', 'error')
+        return redirect(url_for('dashboard'))
+
     output = []
     output.append(['Дата', 'Продажи (Руб)', 'Закупки (Руб)', 'Прибыль (Руб)'])
-    
-    today = date.today()
-    for i in range(30):
-        d = today - timedelta(days=i)
-        d_start = datetime.combine(d, datetime.min.time())
-        d_end = d_start + timedelta(days=1)
-        
-        sales = db.session.query(func.sum(MenuItem.price)).join(Order).filter(Order.timestamp >= d_start, Order.timestamp < d_end, Order.status != 'Issued (Sub)').scalar() or 0
-        expenses = db.session.query(func.sum(SupplyRequest.total_cost)).filter(SupplyRequest.created_at >= d_start, SupplyRequest.created_at < d_end, SupplyRequest.status == 'Approved').scalar() or 0
-        
-        output.append([d.strftime('%Y-%m-%d'), sales, expenses, sales - expenses])
+    for row in daily_report(start_day, end_day):
+        output.append([row['date'].strftime('%Y-%m-%d'), row['sales'], row['expenses'], row['profit']])
     
     si = io.StringIO()
     cw = csv.writer(si)
     cw.writerows(output)
     response = make_response(si.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=monthly_report.csv"
+    filename = "monthly_report.csv" if not request.args else f"report_{start_day}_{end_day}.csv"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
     response.headers["Content-type"] = "text/csv"
     return response
 
+@app.route('/export_orders')
+@login_required
+def export_orders():
+    if current_user.role != 'admin': return redirect(url_for('dashboard'))
+
+    # Выгрузка заказов построчно в CSV: ?start=&end= (или ?days=), фильтры см. export_filters, ?gzip=1 - сжатие
+    try:
+        start_day, end_day = report_period(request.args)
+        orders = order_history(day_start(start_day), day_start(end_day + timedelta(days=1)))
+        conditions = export_filters(request.args, orders)
+    except ValueError:
+        flash('Некорректные параметры выгрузки', 'error')
+        return redirect(url_for('dashboard'))
+
+    filename = f"orders_{start_day}_{end_day}.csv"
+    chunks = export_csv_chunks(order_export_query(orders, conditions))
+    if request.args.get('gzip') == '1':
+        response = app.response_class(stream_with_context(gzip_chunks(chunks)), mimetype='application/gzip')
+        filename += '.gz'
+    else:
+        response = app.response_class(stream_with_context(chunks), mimetype='text/csv')
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
 @app.route('/publish_dish/<int:item_id>', methods=['POST'])
 @login_required
 def publish_dish(item_id):
@@ -605,11 +2632,79 @@ def publish_dish(item_id):
     item = MenuItem.query.get(item_id)
     if item:
         item.is_active = True
+        menu_changed()
         db.session.commit()
         notify_role('student', f"Меню обновлено! Блюдо '{item.name}' теперь доступно для заказа")
         flash(f'Блюдо {item.name} опубликовано в меню!', 'success')
     return redirect(url_for('dashboard'))
 
+@app.route('/api/menu')
+@login_required
+def menu_api():
+    # Легкий JSON для обновления остатков на странице ученика без перезагрузки
+    version, items = menu_cache.available_items()
+    return jsonify({
+        'version': version,
+        'items': [{'id': i.id, 'name': i.name, 'price': i.price, 'category': i.category, 'quantity': i.quantity,
+                   'has_allergy': bool(i.allergen_mask & current_user.allergy_mask)} for i in items]
+    })
+
+@app.route('/api/reviews')
+@login_required
+def reviews_api():
+    # Страница отзывов: ?sort=newest|oldest|rating_high|rating_low&cursor=...&limit=N&item_id=N
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    limit = min(max(request.args.get('limit', REVIEW_PAGE_SIZE, type=int), 1), REVIEW_PAGE_MAX)
+    try:
+        rows, next_cursor = review_page(request.args.get('sort', 'newest'), request.args.get('cursor'),
+                                        limit, request.args.get('item_id', type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'reviews': [review_payload(row) for row in rows], 'next_cursor': next_cursor})
+
+@app.route('/api/reviews/summary')
+@login_required
+def reviews_summary_api():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'items': review_summary()})
+
+@app.route('/api/system_stats')
+@login_required
+def system_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'notifications': notification_dispatcher.metrics(), 'menu_cache': dict(menu_cache.stats),
+                    'user_cache': user_cache.metrics(), 'requests': request_metrics.snapshot(),
+                    'archive': archive_state['last_run']})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Метрики для Prometheus: гистограммы времени и числа SQL-запросов по маршрутам
+    token = app.config['METRICS_TOKEN']
+    if token:
+        allowed = request.headers.get('Authorization') == f'Bearer {token}'
+    else:
+        allowed = current_user.is_authenticated and current_user.role == 'admin'
+    if not allowed:
+        return app.response_class('Unauthorized\n', status=401, mimetype='text/plain')
+    return app.response_class(instrumentation.prometheus_text(request_metrics), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profile')
+@login_required
+def profile_report():
+    # Свернутые стеки выборочного профайлера (включается PROFILER_INTERVAL_MS); ?reset=1 - начать заново
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    if stack_sampler is None:
+        return jsonify({'error': 'Профайлер выключен: задайте PROFILER_INTERVAL_MS'}), 404
+    samples, stacks = stack_sampler.report(request.args.get('limit', 50, type=int))
+    if request.args.get('reset') == '1':
+        stack_sampler.reset()
+    body = f'# samples: {samples}\n' + ''.join(f'{stack} {count}\n' for stack, count in stacks)
+    return app.response_class(body, mimetype='text/plain')
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -622,21 +2717,27 @@ def reset_db():
     db.session.remove()
     db.engine.dispose()
     
-    db_path = os.path.join(app.root_path, 'canteen.db')
-    if os.path.exists(db_path):
+    db_path = db.engine.url.database if db.engine.dialect.name == 'sqlite' else None
+    if db_path and os.path.exists(db_path):
         try:
             os.remove(db_path) # Удаляем файл целиком
+            for suffix in ('-wal', '-shm'): # Файлы журнала WAL
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
         except Exception:
             with app.app_context():
                 db.drop_all() # Если файл занят, очищаем таблицы
+    elif not db_path:
+        db.drop_all() # PostgreSQL: файла нет, очищаем таблицы
+    user_cache.clear() # Снимки удаленных пользователей больше не действительны
 
     # 2. Создание чистой базы
     with app.app_context():
-        db.create_all()
+        migrate_schema()
         
         # Создаем админа
         if not User.query.filter_by(role='admin').first():
-            hashed_pw = generate_password_hash('admin', method='scrypt')
+            hashed_pw = hash_password('admin')
             admin = User(username='admin', password_hash=hashed_pw, role='admin')
             db.session.add(admin)
             db.session.commit()
@@ -0,0 +1,5 @@
+"""Бенчмарки и нагрузочные сценарии Smart Столовой.
+
+Каждый модуль запускается отдельно: ``python -m benchmarks.<имя>``.
+База создается во временном файле, рабочая canteen.db не затрагивается.
+"""
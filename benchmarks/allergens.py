@@ -0,0 +1,76 @@
+"""Бенчмарк отчета по аллергенам: тысячи учеников x все меню должны проверяться за миллисекунды.
+
+Перед замером проверяется разбор текста: отрицания и слова, похожие на основы аллергенов.
+
+Запуск: ``python -m benchmarks.allergens``
+"""
+import random
+import time
+
+from benchmarks.common import load_app
+
+STUDENTS = 5000
+DISHES = 80
+LIMIT_SECONDS = 0.5
+ALLERGY_TEXTS = ['', '', '', 'молоко', 'орехи, арахис', 'глютен', 'яйца', 'рыба', 'мед и цитрусовые', 'соя']
+# (текст, ожидаемые аллергены)
+PARSE_CASES = [
+    ('без глютена', []),
+    ('без орехов', []),
+    ('Без глютена и лактозы', []),
+    ('не содержит орехов', []),
+    ('нет', []),
+    ('молоко, без глютена', ['молоко']),
+    ('сырники без сахара', ['молоко']),
+    ('медведь', []),
+    ('медицина', []),
+    ('рожки', []),
+    ('сельдерей', ['сельдерей']),
+    ('мед, с медом, медовый', ['мед']),
+    ('рожь, овсянка, мукой', ['глютен']),
+    ('раки, сельдь', ['рыба', 'ракообразные']),
+]
+
+
+def seed(canteen):
+    db = canteen.db
+    random.seed(42)
+    users = []
+    for i in range(STUDENTS):
+        text = random.choice(ALLERGY_TEXTS)
+        users.append({'username': f'student{i}', 'password_hash': '-', 'role': 'student', 'allergies': text,
+                      'allergy_mask': canteen.allergens.to_mask(text), 'balance': 0.0,
+                      'broadcast_read_id': 0, 'notif_version': 0})
+    dishes = []
+    for i in range(DISHES):
+        text = ', '.join(random.sample(ALLERGY_TEXTS[3:], random.randint(0, 2)))
+        dishes.append({'name': f'Блюдо {i}', 'price': 100.0, 'category': 'breakfast' if i % 2 else 'lunch',
+                       'quantity': 100, 'allergens': text, 'allergen_mask': canteen.allergens.to_mask(text), 'is_active': True})
+    db.session.execute(canteen.User.__table__.insert(), users)
+    db.session.execute(canteen.MenuItem.__table__.insert(), dishes)
+    db.session.commit()
+
+
+def check_parse(allergens):
+    for text, expected in PARSE_CASES:
+        found = allergens.names(allergens.to_mask(text))
+        assert found == expected, f'Разбор {text!r}: {found}, ожидалось {expected}'
+
+
+def run():
+    canteen = load_app()
+    check_parse(canteen.allergens)
+    with canteen.app.app_context():
+        seed(canteen)
+        started = time.perf_counter()
+        report = canteen.allergen_safety_report()
+        elapsed = time.perf_counter() - started
+    blocked = {category: len(rows) for category, rows in report['no_safe_dish'].items()}
+    print(f"{report['students']} учеников ({report['students_with_allergies']} с аллергиями) x {len(report['dishes'])} блюд: "
+          f"{elapsed * 1000:.0f} мс (матрица {report['compute_ms']} мс), без безопасного блюда: {blocked}")
+    assert elapsed < LIMIT_SECONDS, f'Отчет по аллергенам считается слишком долго: {elapsed:.2f} с'
+    print('OK')
+
+
+if __name__ == '__main__':
+    run()
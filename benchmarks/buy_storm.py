@@ -0,0 +1,97 @@
+"""Нагрузочный тест покупок: параллельные запросы /buy не должны продавать больше остатка.
+
+Несколько потоков одновременно покупают одно блюдо (каждый - своей сессией через
+Flask test client), часть учеников покупает с одного счета из нескольких потоков.
+После шторма проверяется, что склад и балансы сходятся с созданными заказами.
+
+Запуск: ``python -m benchmarks.buy_storm [--threads 16] [--requests 40] [--stock 200]``
+"""
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.common import load_app
+
+PRICE = 50.0
+STUDENT_BALANCE = 500.0
+
+
+def seed(canteen, students, stock):
+    db = canteen.db
+    password_hash = generate_password_hash('pw', method='pbkdf2:sha256:1')
+    db.session.add_all([canteen.User(username=f'student{i}', password_hash=password_hash, role='student',
+                                     balance=STUDENT_BALANCE) for i in range(students)])
+    dish = canteen.MenuItem(name='Котлета', price=PRICE, category='lunch', quantity=stock, is_active=True)
+    db.session.add(dish)
+    db.session.commit()
+    return dish.id
+
+
+def login(canteen, username):
+    client = canteen.app.test_client()
+    client.post('/login', data={'username': username, 'password': 'pw'})
+    return client
+
+
+def run(threads, requests_per_thread, stock):
+    canteen = load_app()
+    students = max(threads // 2, 1) # По два потока на ученика: гонка и за складом, и за балансом
+    with canteen.app.app_context():
+        dish_id = seed(canteen, students, stock)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(n):
+        client = login(canteen, f'student{n % students}')
+        local = []
+        for _ in range(requests_per_thread):
+            started = time.perf_counter()
+            response = client.get(f'/buy/{dish_id}?quantity={random.randint(1, 3)}')
+            if response.status_code != 302:
+                errors.append(response.status_code)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+
+    with canteen.app.app_context():
+        db = canteen.db
+        left = db.session.get(canteen.MenuItem, dish_id).quantity
+        sold = db.session.query(db.func.coalesce(db.func.sum(canteen.Order.quantity), 0)).scalar()
+        negative = canteen.User.query.filter(canteen.User.balance < 0).count()
+        mismatched = 0
+        for user in canteen.User.query.filter_by(role='student'):
+            spent = sum(o.quantity * o.unit_price for o in canteen.Order.query.filter_by(user_id=user.id))
+            if abs(user.balance - (STUDENT_BALANCE - spent)) > 1e-6:
+                mismatched += 1
+
+    total = threads * requests_per_thread
+    latencies.sort()
+    print(f'{total} запросов за {elapsed:.2f} с ({total / elapsed:.0f} req/s), '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс')
+    print(f'Остаток: {left}, продано: {sold}, начальный склад: {stock}')
+    assert not errors, f'Ошибки сервера: {errors[:10]}'
+    assert left >= 0, 'Остаток ушел в минус'
+    assert left + sold == stock, 'Продано больше, чем было на складе'
+    assert negative == 0, 'Баланс ученика ушел в минус'
+    assert mismatched == 0, 'Списания с баланса не совпадают с заказами'
+    print('OK: перепродаж и расхождений баланса нет')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--stock', type=int, default=60) # Меньше суммарного баланса учеников
+    args = parser.parse_args()
+    run(args.threads, args.requests, args.stock)
@@ -0,0 +1,47 @@
+"""Общие помощники бенчмарков: временная база, счетчик SQL-запросов, перцентили."""
+import math
+import os
+import tempfile
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+def load_app(db_path=None):
+    """Импортирует приложение, направив его на отдельную SQLite-базу."""
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(prefix='canteen-bench-', suffix='.db')
+        os.close(fd)
+        os.remove(db_path)
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    import app as canteen
+    canteen.app.config['TESTING'] = True
+    return canteen
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    """Считает SQL-запросы, выполненные движком внутри блока."""
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+def percentile(values, p):
+    """Перцентиль p (0-100) методом ближайшего ранга; values должны быть отсортированы."""
+    if not values:
+        return 0.0
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
@@ -0,0 +1,60 @@
+"""Бенчмарк прогноза закупок: год истории продаж по всем блюдам, пересчитанный в расход продуктов
+по техкартам, должен считаться быстрее секунды.
+
+Запуск: ``python -m benchmarks.forecast``
+"""
+import random
+import time
+from datetime import date, timedelta
+
+from benchmarks.common import load_app
+
+DISHES = 300
+PRODUCTS = 150
+INGREDIENTS_PER_DISH = 3
+DAYS = 365
+LIMIT_SECONDS = 1.0
+
+
+def seed(canteen, today):
+    db = canteen.db
+    random.seed(42)
+    dishes = [canteen.MenuItem(name=f'Блюдо {i}', price=100, category='lunch', quantity=random.randint(0, 40), is_active=True)
+              for i in range(DISHES)]
+    products = [canteen.MenuItem(name=f'Продукт {i}', price=0, category='product', quantity=random.randint(0, 2000),
+                                 is_active=False) for i in range(PRODUCTS)]
+    db.session.add_all(dishes + products)
+    db.session.flush()
+    recipes = [{'dish_id': dish.id, 'product_id': product.id, 'amount': random.randint(1, 5)}
+               for dish in dishes for product in random.sample(products, INGREDIENTS_PER_DISH)]
+    rows = []
+    for dish in dishes:
+        base = random.uniform(2, 30)
+        for offset in range(DAYS):
+            day = today - timedelta(days=offset)
+            if day.weekday() >= 5:
+                continue  # По выходным столовая закрыта
+            rows.append({'day': day, 'item_id': dish.id, 'portions': max(0, int(random.gauss(base, base / 4))),
+                         'sub_portions': 0, 'revenue': 0.0, 'new_students': 0})
+    db.session.execute(canteen.RecipeIngredient.__table__.insert(), recipes)
+    db.session.execute(canteen.DailySales.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def run():
+    canteen = load_app()
+    today = date.today()
+    with canteen.app.app_context():
+        rows = seed(canteen, today)
+        started = time.perf_counter()
+        plan = canteen.supply_forecast(today)
+        elapsed = time.perf_counter() - started
+    urgent = sum(1 for p in plan if p['priority'] == 'Urgent')
+    print(f'{DISHES} блюд, {PRODUCTS} продуктов, {rows} строк истории: {len(plan)} заявок ({urgent} срочных) за {elapsed * 1000:.0f} мс')
+    assert elapsed < LIMIT_SECONDS, f'Прогноз считается слишком долго: {elapsed:.2f} с'
+    print('OK')
+
+
+if __name__ == '__main__':
+    run()
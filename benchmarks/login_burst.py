@@ -0,0 +1,55 @@
+"""Пиковый вход класса: сколько входов в секунду выдерживает один worker.
+
+Параллельные потоки одновременно логинятся разными учениками через Flask test client.
+Печатается пропускная способность и задержки для выбранного метода хэширования и
+размера пула PASSWORD_HASH_WORKERS, чтобы подобрать число worker'ов под перемену.
+
+Запуск: ``python -m benchmarks.login_burst [--students 60] [--threads 30]
+[--method scrypt] [--workers 0]``
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=60)
+    parser.add_argument('--threads', type=int, default=30)
+    parser.add_argument('--method', default='scrypt', help='PASSWORD_HASH_METHOD, например scrypt:16384:8:1')
+    parser.add_argument('--workers', type=int, default=0, help='PASSWORD_HASH_WORKERS (0 - хэш в потоке запроса)')
+    args = parser.parse_args()
+
+    os.environ['PASSWORD_HASH_METHOD'] = args.method
+    os.environ['PASSWORD_HASH_WORKERS'] = str(args.workers)
+    canteen = load_app()
+    with canteen.app.app_context():
+        password_hash = canteen.hash_password('pw') # Один хэш на всех: считать его N раз незачем
+        canteen.db.session.add_all([canteen.User(username=f'student{i}', password_hash=password_hash, role='student')
+                                    for i in range(args.students)])
+        canteen.db.session.commit()
+
+    def login(n):
+        client = canteen.app.test_client()
+        started = time.perf_counter()
+        response = client.post('/login', data={'username': f'student{n}', 'password': 'pw'})
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(login, range(args.students)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    failed = sum(1 for _, status in results if status != 302)
+    print(f'{args.method}, пул хэширования: {args.workers or "нет"}')
+    print(f'{args.students} входов за {elapsed:.2f} с: {args.students / elapsed:.1f} входов/с, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.0f} мс, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f} мс, '
+          f'ошибок: {failed}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Регрессионный бенчмарк очереди кухни: число SQL-запросов не должно расти с числом заказов.
+
+Запуск: ``python -m benchmarks.order_queries``
+"""
+import time
+
+from benchmarks.common import count_queries, load_app
+
+ORDER_COUNTS = [10, 100, 300, 1000]
+
+
+def seed(canteen, orders):
+    db = canteen.db
+    students = [canteen.User(username=f'student{i}', password_hash='-', role='student') for i in range(50)]
+    dishes = [canteen.MenuItem(name=f'Блюдо {i}', price=100, category='lunch', quantity=1000, is_active=True) for i in range(20)]
+    db.session.add_all(students + dishes)
+    db.session.flush()
+    for i in range(orders):
+        db.session.add(canteen.Order(user_id=students[i % len(students)].id,
+                                     item_id=dishes[i % len(dishes)].id,
+                                     status='Issued'))
+    db.session.commit()
+
+
+def run():
+    canteen = load_app()
+    results = []
+    for orders in ORDER_COUNTS:
+        with canteen.app.app_context():
+            canteen.db.drop_all()
+            canteen.db.create_all()
+            seed(canteen, orders)
+            canteen.db.session.expunge_all()
+            started = time.perf_counter()
+            with count_queries(canteen.db.engine) as counter:
+                data = canteen.open_orders_data()
+            elapsed = (time.perf_counter() - started) * 1000
+            assert len(data) == orders
+            results.append((orders, counter.count, elapsed))
+            print(f'{orders:>6} заказов: {counter.count} запрос(ов), {elapsed:.1f} мс')
+
+    query_counts = {count for _, count, _ in results}
+    assert len(query_counts) == 1, f'Число запросов растет с числом заказов: {results}'
+    print('OK: число запросов постоянно')
+
+
+if __name__ == '__main__':
+    run()
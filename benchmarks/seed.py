@@ -0,0 +1,148 @@
+"""Генератор синтетической столовой: ученики, блюда, продукты и месяцы истории.
+
+Создает N учеников, повара, M блюд с техкартами и историю за несколько месяцев учебных дней:
+заказы, отзывы, личные уведомления и рассылки, заявки на закупку. Затем пересчитывает
+сводку продаж. Все строки вставляются пачками (executemany), год истории - секунды.
+
+Пароль всех созданных пользователей - ``pw``.
+
+Запуск: ``python -m benchmarks.seed [--db canteen.db] [--students 600] [--dishes 40] [--months 6]``
+(относительный путь базы, как и в приложении, считается от папки instance/)
+"""
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks.common import load_app
+
+PASSWORD = 'pw'
+ORDER_RATE = 0.7  # Доля учеников, которые едят в столовой в учебный день
+REVIEW_RATE = 0.05
+SUBSCRIPTION_RATE = 0.1
+ALLERGIES = ['', '', '', '', 'молоко', 'орехи', 'глютен', 'яйца']
+BATCH = 5000
+
+
+def school_days(months, today):
+    day = today - timedelta(days=months * 30)
+    while day < today:
+        if day.weekday() < 5:
+            yield day
+        day += timedelta(days=1)
+
+
+def insert(conn, table, rows):
+    for start in range(0, len(rows), BATCH):
+        conn.execute(table.insert(), rows[start:start + BATCH])
+
+
+def seed_canteen(canteen, students=600, dishes=40, months=6, open_orders=40, seed=42):
+    """Заполняет базу приложения; возвращает словарь с числом созданных строк."""
+    rng = random.Random(seed)
+    db = canteen.db
+    today = date.today()
+    now = datetime.utcnow()
+    if canteen.User.query.filter_by(username='student0').first():
+        raise SystemExit('В базе уже есть сгенерированные данные (student0)')
+
+    password_hash = canteen.hash_password(PASSWORD)  # Один хэш на всех: считать его N раз незачем
+    counts = {}
+    with db.engine.begin() as conn:
+        users = []
+        for i in range(students):
+            allergies = rng.choice(ALLERGIES)
+            users.append({'username': f'student{i}', 'password_hash': password_hash, 'role': 'student', 'allergies': allergies,
+                          'allergy_mask': canteen.allergens.to_mask(allergies), 'balance': 100000.0,
+                          'broadcast_read_id': 0, 'notif_version': 0})
+        users.append({'username': 'cook', 'password_hash': password_hash, 'role': 'cook', 'allergies': '',
+                      'allergy_mask': 0, 'balance': 0.0, 'broadcast_read_id': 0, 'notif_version': 0})
+        insert(conn, canteen.User.__table__, users)
+        student_ids = [row[0] for row in conn.execute(
+            db.select(canteen.User.id).where(canteen.User.role == 'student', canteen.User.username.like('student%')))]
+
+        products = [{'name': f'Продукт {i}', 'price': 0.0, 'category': 'product', 'quantity': 10 ** 7,
+                     'date': today, 'allergens': '', 'allergen_mask': 0, 'is_active': False} for i in range(max(dishes // 2, 1))]
+        menu = []
+        for i in range(dishes):
+            dish_allergens = rng.choice(ALLERGIES)
+            menu.append({'name': f'Блюдо {i}', 'price': float(rng.randrange(40, 220, 10)),
+                         'category': 'breakfast' if i % 2 else 'lunch', 'quantity': 10 ** 6, 'date': today,
+                         'allergens': dish_allergens, 'allergen_mask': canteen.allergens.to_mask(dish_allergens), 'is_active': True})
+        insert(conn, canteen.MenuItem.__table__, products + menu)
+        items = conn.execute(db.select(canteen.MenuItem.id, canteen.MenuItem.category, canteen.MenuItem.price)).all()
+        product_ids = [i.id for i in items if i.category == 'product']
+        dish_prices = {i.id: i.price for i in items if i.category != 'product'}
+        dish_ids = list(dish_prices)
+        insert(conn, canteen.RecipeIngredient.__table__, [
+            {'dish_id': dish_id, 'product_id': product_id, 'amount': rng.randint(1, 3)}
+            for dish_id in dish_ids for product_id in rng.sample(product_ids, min(2, len(product_ids)))])
+
+        orders, reviews, notifications, broadcasts, supply = [], [], [], [], []
+        for day in school_days(months, today):
+            opening = datetime.combine(day, datetime.min.time()) + timedelta(hours=8)
+            for user_id in student_ids:
+                if rng.random() > ORDER_RATE:
+                    continue
+                for _ in range(rng.choice((1, 1, 2))):
+                    dish_id = rng.choice(dish_ids)
+                    quantity = rng.choice((1, 1, 1, 2))
+                    timestamp = opening + timedelta(minutes=rng.randrange(0, 7 * 60))
+                    sub = rng.random() < SUBSCRIPTION_RATE
+                    orders.append({'user_id': user_id, 'item_id': dish_id, 'quantity': quantity, 'issued': quantity,
+                                   'unit_price': dish_prices[dish_id], 'state': canteen.ORDER_COMPLETED,
+                                   'status': canteen.SUBSCRIPTION_STATUS if sub else 'Issued', 'timestamp': timestamp})
+                    notifications.append({'user_id': user_id, 'message': f'Ваш заказ готов к выдаче! ({dish_id})',
+                                          'is_read': True, 'created_at': timestamp + timedelta(minutes=5)})
+                    if rng.random() < REVIEW_RATE:
+                        reviews.append({'user_id': user_id, 'item_id': dish_id, 'rating': rng.randint(1, 5),
+                                        'comment': 'Сгенерированный отзыв', 'timestamp': timestamp + timedelta(minutes=30)})
+            broadcasts.append({'role': 'student', 'message': 'Меню обновлено!', 'created_at': opening})
+            broadcasts.append({'role': 'cook', 'message': 'Внимание! Заканчивается: Продукт 0 (3)', 'created_at': opening})
+            if day.weekday() == 0:
+                for n in rng.sample(range(len(product_ids)), min(3, len(product_ids))):
+                    supply.append({'product_name': f'Продукт {n}', 'quantity': rng.randint(10, 100),
+                                   'priority': rng.choice(('Urgent', 'Planned')), 'status': 'Approved',
+                                   'total_cost': float(rng.randint(500, 5000)), 'created_at': opening})
+        # Очередь кухни прямо сейчас и непрочитанные уведомления
+        for _ in range(open_orders):
+            dish_id = rng.choice(dish_ids)
+            orders.append({'user_id': rng.choice(student_ids), 'item_id': dish_id, 'quantity': 1, 'issued': 0,
+                           'unit_price': dish_prices[dish_id], 'state': canteen.ORDER_OPEN, 'status': 'Issued',
+                           'timestamp': now - timedelta(minutes=rng.randrange(0, 60))})
+        for user_id in rng.sample(student_ids, min(len(student_ids), 50)):
+            notifications.append({'user_id': user_id, 'message': 'Ваш заказ готов к выдаче!', 'is_read': False, 'created_at': now})
+        supply += [{'product_name': 'Продукт 0', 'quantity': 20, 'priority': 'Urgent', 'status': 'Pending',
+                    'total_cost': 1000.0, 'created_at': now}]
+
+        insert(conn, canteen.Order.__table__, orders)
+        insert(conn, canteen.Review.__table__, reviews)
+        insert(conn, canteen.Notification.__table__, notifications)
+        insert(conn, canteen.BroadcastMessage.__table__, broadcasts)
+        insert(conn, canteen.SupplyRequest.__table__, supply)
+        counts['daily_sales'] = canteen.rebuild_daily_sales(conn)
+
+    counts.update(students=students, dishes=dishes, products=len(products), orders=len(orders), reviews=len(reviews),
+                  notifications=len(notifications), broadcasts=len(broadcasts), supply_requests=len(supply))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='canteen.db', help='Файл SQLite (по умолчанию - база приложения)')
+    parser.add_argument('--students', type=int, default=600)
+    parser.add_argument('--dishes', type=int, default=40)
+    parser.add_argument('--months', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    canteen = load_app(args.db)
+    started = time.perf_counter()
+    with canteen.app.app_context():
+        counts = seed_canteen(canteen, args.students, args.dishes, args.months, seed=args.seed)
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+    print(f'Готово за {time.perf_counter() - started:.1f} с. Пароль пользователей: {PASSWORD}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Нагрузочный набор «большая перемена»: сценарии по реальным маршрутам и сравнение с базовой линией.
+
+База заполняется генератором benchmarks.seed, затем сценарии гоняют маршруты через
+Flask test client из нескольких потоков:
+
+* login_burst - одновременный вход учеников;
+* buy_storm - шторм покупок /buy;
+* cook_polling - опрос очереди /api/get_orders экранами кухни;
+* admin_dashboard - дашборд администратора;
+* download_report - CSV-отчет за 90 дней и построчная выгрузка заказов.
+
+Каждый сценарий прогоняется ``--runs`` раз, p50/p95/p99 задержки считаются по запросам всех прогонов
+вместе; печатается и число SQL-запросов на запрос (из заголовка Server-Timing, см. instrumentation.py;
+у потоковых ответов, например выгрузки заказов, заголовка нет - они в это число не входят).
+
+Базовых линий две. ``baseline.json`` (в репозитории) хранит только то, что не зависит от машины:
+число SQL-запросов на запрос и ошибок. Задержки сохраняются в ``baseline.local.json`` (не коммитится)
+и сравниваются, только если та базовая линия снята на этой же машине с теми же параметрами. По умолчанию
+сравнивается медиана (``--latency-stat p50_ms``): хвост p95 в сценариях с записью зависит от ожидания
+блокировки SQLite и от фоновой нагрузки машины и меняется от прогона к прогону в полтора-два раза.
+``--save`` записывает обе, ``--compare`` сравнивает с ними и завершается с кодом 1 при регрессии.
+
+Запуск: ``python -m benchmarks.suite [--students 300] [--months 3] [--threads 8] [--runs 3] [--save | --compare]``
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.common import load_app, percentile
+from benchmarks.seed import PASSWORD, seed_canteen
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+LOCAL_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.local.json')
+PORTABLE_STATS = ('requests', 'errors', 'queries_mean', 'queries_max')
+LATENCY_STATS = ('p50_ms', 'p95_ms', 'p99_ms')
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+
+def timed(client, method, url, **kwargs):
+    started = time.perf_counter()
+    response = client.open(url, method=method, **kwargs)
+    response.get_data()  # Потоковые ответы читаем до конца
+    elapsed = time.perf_counter() - started
+    match = QUERIES_RE.search(response.headers.get('Server-Timing', ''))
+    return elapsed, int(match.group(1)) if match else None, response.status_code
+
+
+def login(canteen, username, password=PASSWORD):
+    client = canteen.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302, f'Не удалось войти как {username}'
+    return client
+
+
+def run_parallel(threads, jobs):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(lambda job: job(), jobs))
+
+
+def login_burst(canteen, args):
+    def job(n):
+        client = canteen.app.test_client()
+        return lambda: timed(client, 'POST', '/login', data={'username': f'student{n}', 'password': PASSWORD})
+    return run_parallel(args.threads, [job(n) for n in range(min(args.logins, args.students))]), 302
+
+
+def buy_storm(canteen, args):
+    with canteen.app.app_context():
+        dish_ids = [i.id for i in canteen.MenuItem.query.filter(canteen.MenuItem.is_active == True)]
+    clients = [login(canteen, f'student{n}') for n in range(args.threads)]
+    rng = random.Random(1)
+    jobs = [lambda c=clients[n % len(clients)], d=rng.choice(dish_ids): timed(c, 'GET', f'/buy/{d}?quantity=1')
+            for n in range(args.requests)]
+    return run_parallel(args.threads, jobs), 302
+
+
+def cook_polling(canteen, args):
+    clients = [login(canteen, 'cook') for _ in range(min(args.threads, 4))]
+    jobs = [lambda c=clients[n % len(clients)]: timed(c, 'GET', '/api/get_orders') for n in range(args.requests)]
+    return run_parallel(args.threads, jobs), 200
+
+
+def admin_dashboard(canteen, args):
+    client = login(canteen, 'admin', 'admin')
+    jobs = [lambda: timed(client, 'GET', '/dashboard') for _ in range(args.admin_requests)]
+    return run_parallel(2, jobs), 200
+
+
+def download_report(canteen, args):
+    client = login(canteen, 'admin', 'admin')
+    jobs = []
+    for _ in range(args.admin_requests):
+        jobs.append(lambda: timed(client, 'GET', '/download_report?days=90'))
+        jobs.append(lambda: timed(client, 'GET', '/export_orders?days=90'))
+    return run_parallel(2, jobs), 200
+
+
+SCENARIOS = {
+    'login_burst': login_burst,
+    'buy_storm': buy_storm,
+    'cook_polling': cook_polling,
+    'admin_dashboard': admin_dashboard,
+    'download_report': download_report,
+}
+
+
+def summarize(results, expected_status, elapsed):
+    latencies = sorted(latency for latency, _, _ in results)
+    queries = [q for _, q, _ in results if q is not None]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, _, status in results if status != expected_status),
+        'rps': round(len(results) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def portable(report):
+    # Часть отчета, которая не зависит от машины: ее можно хранить в репозитории
+    return {
+        'params': report['params'],
+        'scenarios': {name: {key: stats[key] for key in PORTABLE_STATS} for name, stats in report['scenarios'].items()},
+    }
+
+
+def same_machine(report, baseline):
+    return baseline.get('environment') == report['environment'] and baseline.get('params') == report['params']
+
+
+def compare(report, baseline, tolerance, margin_ms, latency_baseline=None, stat='p50_ms'):
+    regressions = []
+    for name, current in report['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base:
+            if base['queries_mean'] is not None and current['queries_mean'] is not None \
+                    and current['queries_mean'] > base['queries_mean'] + 0.5:
+                regressions.append(f"{name}: SQL-запросов на запрос {current['queries_mean']} > {base['queries_mean']}")
+            if current['errors'] > base['errors']:
+                regressions.append(f"{name}: ошибок {current['errors']} > {base['errors']}")
+        base = latency_baseline and latency_baseline['scenarios'].get(name)
+        # Рост задержки считается регрессией, только если он больше и относительного, и абсолютного порога:
+        # у быстрых сценариев задержка в единицы миллисекунд от прогона к прогону скачет в разы
+        if base and current[stat] > base[stat] * tolerance + margin_ms:
+            regressions.append(f"{name}: {stat} {current[stat]} мс > {base[stat]} мс x {tolerance} + {margin_ms} мс")
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=300)
+    parser.add_argument('--dishes', type=int, default=30)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=40)
+    parser.add_argument('--requests', type=int, default=200, help='Запросов в buy_storm и cook_polling')
+    parser.add_argument('--admin-requests', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=3, help='Прогонов каждого сценария (перцентили - по всем прогонам)')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='Только выбранные сценарии')
+    parser.add_argument('--baseline', default=BASELINE, help='Базовая линия SQL-запросов и ошибок')
+    parser.add_argument('--latency-baseline', default=LOCAL_BASELINE, help='Базовая линия задержек этой машины')
+    parser.add_argument('--save', action='store_true', help='Сохранить результат как базовую линию')
+    parser.add_argument('--compare', action='store_true', help='Сравнить с базовой линией')
+    parser.add_argument('--latency-stat', choices=LATENCY_STATS, default='p50_ms', help='Какая задержка сравнивается')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Допустимый рост задержки (во сколько раз)')
+    parser.add_argument('--margin-ms', type=float, default=20.0, help='Допустимый рост задержки сверх tolerance, мс')
+    args = parser.parse_args()
+
+    os.environ['SERVER_TIMING_HEADER'] = '1'
+    canteen = load_app()
+    canteen.app.logger.setLevel('ERROR')  # Предупреждения о медленных запросах здесь - шум: итог в таблице
+    # Повторные прогоны buy_storm бронируют одну и ту же перемену: емкость не должна кончиться посреди замера
+    canteen.app.config['SLOT_CAPACITY'] = 10 ** 6
+    with canteen.app.app_context():
+        counts = seed_canteen(canteen, args.students, args.dishes, args.months)
+    print('Данные: ' + ', '.join(f'{name} {count}' for name, count in counts.items()))
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(), 'db_profile': canteen.app.config['DB_PROFILE'],
+                        'password_hash': canteen.app.config['PASSWORD_HASH_METHOD']},
+        'params': {key: getattr(args, key) for key in ('students', 'dishes', 'months', 'threads', 'logins',
+                                                        'requests', 'admin_requests', 'runs')},
+        'scenarios': {},
+    }
+    print(f"{'сценарий':<16} {'запросов':>8} {'ошибок':>6} {'req/s':>8} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'SQL/запрос':>10}")
+    for name in args.scenario or SCENARIOS:
+        results, elapsed = [], 0.0
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            run_results, expected_status = SCENARIOS[name](canteen, args)
+            elapsed += time.perf_counter() - started
+            results += run_results
+        stats = summarize(results, expected_status, elapsed)
+        report['scenarios'][name] = stats
+        print(f"{name:<16} {stats['requests']:>8} {stats['errors']:>6} {stats['rps']:>8} {stats['p50_ms']:>8} "
+              f"{stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['queries_mean']!s:>10}")
+    canteen.notification_dispatcher.flush()
+
+    if args.save:
+        save_baseline(args.baseline, portable(report))
+        save_baseline(args.latency_baseline, report)
+        print(f'Базовая линия сохранена: {args.baseline}, задержки этой машины: {args.latency_baseline}')
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            raise SystemExit(f'Нет базовой линии {args.baseline}: запустите с --save')
+        latency_baseline = load_baseline(args.latency_baseline)
+        if latency_baseline is not None and not same_machine(report, latency_baseline):
+            latency_baseline = None
+        if latency_baseline is None:
+            print(f'Задержки не сравниваются: нет базовой линии {args.latency_baseline} для этой машины и параметров')
+        regressions = compare(report, baseline, args.tolerance, args.margin_ms, latency_baseline, args.latency_stat)
+        for line in regressions:
+            print('РЕГРЕССИЯ: ' + line)
+        if regressions:
+            sys.exit(1)
+        print('OK: регрессий относительно базовой линии нет')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Прогноз спроса и расчет автозаявок на закупку.
+
+Чистые функции над массивами NumPy, без Flask и базы: app.py собирает расход продуктов
+(продажи блюд из сводки DailySales x техкарты) в матрицу «позиции x дни» и передает ее сюда.
+Все позиции считаются одновременно, поэтому год истории по сотням позиций
+обрабатывается за миллисекунды.
+"""
+import math
+from datetime import timedelta
+
+import numpy as np
+
+MOVING_AVERAGE_DAYS = 28  # Окно скользящего среднего
+LEAD_DAYS = 2  # Сколько дней идет поставка
+COVER_DAYS = 7  # На сколько дней после поставки должно хватить запаса
+SAFETY_Z = 1.65  # Страховой запас: ~95% дней без дефицита
+MIN_STOCK = 5  # Порог «заканчивается» для позиций без истории расхода
+FALLBACK_QUANTITY = 50  # Заявка по умолчанию для позиций без истории
+
+
+def consumption_matrix(item_ids, start_day, end_day, item_index, day_offsets, amounts):
+    """Строит матрицу расхода (позиции x дни) из разреженных строк (позиция, день, количество)."""
+    days = (end_day - start_day).days + 1
+    matrix = np.zeros((len(item_ids), days), dtype=np.float64)
+    if len(amounts):
+        np.add.at(matrix, (np.asarray(item_index), np.asarray(day_offsets)), np.asarray(amounts, dtype=np.float64))
+    return matrix
+
+
+def recipe_consumption(sales, products, product_index, dish_index, amounts):
+    """Расход продуктов (продукты x дни): техкарты (продукты x блюда) @ продажи блюд (блюда x дни)."""
+    recipes = np.zeros((products, sales.shape[0]), dtype=np.float64)
+    if len(amounts):
+        np.add.at(recipes, (np.asarray(product_index), np.asarray(dish_index)), np.asarray(amounts, dtype=np.float64))
+    return recipes @ sales
+
+
+def weekday_factors(matrix, start_day):
+    """Сезонность по дням недели: средний расход в день недели / средний расход, форма (позиции x 7)."""
+    weekdays = (np.arange(matrix.shape[1]) + start_day.weekday()) % 7
+    one_hot = np.eye(7)[weekdays]  # дни x 7
+    counts = one_hot.sum(axis=0)
+    by_weekday = np.divide(matrix @ one_hot, counts, out=np.zeros((matrix.shape[0], 7)), where=counts > 0)
+    overall = matrix.mean(axis=1, keepdims=True)
+    # Без истории сезонности нет: коэффициент 1 для всех дней
+    return np.divide(by_weekday, overall, out=np.ones_like(by_weekday), where=overall > 0)
+
+
+def seasonal_model(matrix, start_day, window=MOVING_AVERAGE_DAYS):
+    """Базовый уровень (скользящее среднее без сезонности) и коэффициенты дней недели."""
+    recent = matrix[:, -window:]
+    factors = weekday_factors(matrix, start_day)
+    if not recent.shape[1]:
+        return np.zeros(matrix.shape[0]), factors
+    # Уровень считается по всем дням окна, включая выходные, поэтому нормируем на среднее
+    # коэффициентов окна: иначе школьные дни недооценивались бы
+    window_weekdays = (np.arange(matrix.shape[1] - recent.shape[1], matrix.shape[1]) + start_day.weekday()) % 7
+    window_factor = factors[:, window_weekdays].mean(axis=1)
+    level = recent.mean(axis=1)
+    return np.divide(level, window_factor, out=np.zeros_like(level), where=window_factor > 0), factors
+
+
+def forecast_demand(matrix, start_day, horizon_start, horizon_days, window=MOVING_AVERAGE_DAYS):
+    """Прогноз расхода на каждый день горизонта: скользящее среднее x коэффициент дня недели."""
+    base, factors = seasonal_model(matrix, start_day, window)
+    horizon_weekdays = (np.arange(horizon_days) + horizon_start.weekday()) % 7
+    return base[:, None] * factors[:, horizon_weekdays]
+
+
+def forecast_error(matrix, start_day, window=MOVING_AVERAGE_DAYS):
+    """Разброс фактического расхода вокруг сезонной модели за последние window дней."""
+    if not matrix.shape[1]:
+        return np.zeros(matrix.shape[0])
+    base, factors = seasonal_model(matrix, start_day, window)
+    recent = matrix[:, -window:]
+    window_weekdays = (np.arange(matrix.shape[1] - recent.shape[1], matrix.shape[1]) + start_day.weekday()) % 7
+    return (recent - base[:, None] * factors[:, window_weekdays]).std(axis=1)
+
+
+def reorder_plan(item_ids, names, stock, pending, matrix, start_day, today,
+                 lead_days=LEAD_DAYS, cover_days=COVER_DAYS, window=MOVING_AVERAGE_DAYS):
+    """Предложения по закупке: список словарей item_id, name, quantity, priority, forecast.
+
+    pending - уже ожидающее согласования количество по каждой позиции: его вычитаем,
+    чтобы повторный запуск не дублировал заявки.
+    """
+    stock = np.asarray(stock, dtype=np.float64)
+    pending = np.asarray(pending, dtype=np.float64)
+    has_history = matrix.sum(axis=1) > 0
+
+    demand = forecast_demand(matrix, start_day, today + timedelta(days=1), lead_days + cover_days, window)
+    lead_demand = demand[:, :lead_days].sum(axis=1)
+    total_demand = demand.sum(axis=1)
+    # Страховой запас от ошибки прогноза, а не от разницы будни/выходные
+    safety = SAFETY_Z * forecast_error(matrix, start_day, window) * math.sqrt(lead_days)
+
+    need = np.ceil(total_demand + safety - stock - pending)
+    urgent = stock < lead_demand + safety  # Закончится раньше, чем придет поставка
+
+    # Позиции без расхода (нет в техкартах, новые продукты): прежнее правило по порогу остатка
+    fallback = ~has_history & (stock < MIN_STOCK)
+    need = np.where(has_history, need, np.where(fallback, FALLBACK_QUANTITY - pending, 0))
+    urgent = np.where(has_history, urgent, fallback)
+
+    plan = []
+    for i in np.flatnonzero(need > 0):
+        plan.append({
+            'item_id': int(item_ids[i]),
+            'name': names[i],
+            'quantity': int(need[i]),
+            'priority': 'Urgent' if urgent[i] else 'Planned',
+            'forecast': round(float(total_demand[i]), 1),
+            'stock': int(stock[i]),
+            'pending': int(pending[i]),
+        })
+    plan.sort(key=lambda p: (p['priority'] != 'Urgent', p['name']))
+    return plan
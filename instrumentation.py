@@ -0,0 +1,247 @@
+"""Инструментирование запросов: время, SQL, шаблоны, медленные запросы, метрики Prometheus.
+
+Подключается из app.py вызовом ``init_app(app, db)``. Для каждого запроса считаются
+общее время, число и время SQL-запросов (события SQLAlchemy), время рендера шаблонов
+(сигналы Flask). Итоги попадают в гистограммы по маршрутам, которые отдаются в текстовом
+формате Prometheus (см. ``prometheus_text``). Запросы дольше SLOW_REQUEST_MS пишутся в лог.
+
+Выборочный профайлер (StackSampler) включается только переменной PROFILER_INTERVAL_MS:
+фоновый поток раз в N мс снимает стеки всех потоков. Когда он выключен, поток не создается
+и накладных расходов нет.
+"""
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+# Долгие соединения (SSE) не считаем: их время - это время жизни потока, а не обработки
+EXCLUDED_ENDPOINTS = {'order_stream', 'static'}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}  # (endpoint, method) -> Histogram
+        self.queries = {}  # endpoint -> Histogram
+        self.sql_seconds = Counter()  # endpoint -> сумма
+        self.template_seconds = Counter()  # шаблон -> сумма
+        self.template_renders = Counter()
+        self.responses = Counter()  # (endpoint, method, status) -> число
+        self.slow = Counter()  # endpoint -> число
+
+    def observe_request(self, endpoint, method, status, seconds, queries, sql_seconds, slow):
+        with self._lock:
+            if (endpoint, method) not in self.durations:
+                self.durations[(endpoint, method)] = Histogram(DURATION_BUCKETS)
+            self.durations[(endpoint, method)].observe(seconds)
+            if endpoint not in self.queries:
+                self.queries[endpoint] = Histogram(QUERY_BUCKETS)
+            self.queries[endpoint].observe(queries)
+            self.sql_seconds[endpoint] += sql_seconds
+            self.responses[(endpoint, method, status)] += 1
+            if slow:
+                self.slow[endpoint] += 1
+
+    def observe_template(self, name, seconds):
+        with self._lock:
+            self.template_seconds[name] += seconds
+            self.template_renders[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'routes': {f'{method} {endpoint}': {'requests': h.total, 'avg_ms': round(h.sum / h.total * 1000, 2),
+                                                    'avg_queries': round(self.queries[endpoint].sum / self.queries[endpoint].total, 2)}
+                           for (endpoint, method), h in sorted(self.durations.items())},
+                'slow_requests': dict(self.slow),
+            }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, histogram, **labels):
+    lines = []
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {count}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {histogram.total}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.total}')
+    return lines
+
+
+def prometheus_text(metrics, prefix='canteen'):
+    """Метрики в текстовом формате Prometheus (text/plain; version=0.0.4)."""
+    with metrics._lock:
+        lines = [f'# HELP {prefix}_request_duration_seconds Время обработки запроса по маршрутам.',
+                 f'# TYPE {prefix}_request_duration_seconds histogram']
+        for (endpoint, method), histogram in sorted(metrics.durations.items()):
+            lines += _histogram_lines(f'{prefix}_request_duration_seconds', histogram, endpoint=endpoint, method=method)
+        lines += [f'# HELP {prefix}_request_queries Число SQL-запросов на запрос.',
+                  f'# TYPE {prefix}_request_queries histogram']
+        for endpoint, histogram in sorted(metrics.queries.items()):
+            lines += _histogram_lines(f'{prefix}_request_queries', histogram, endpoint=endpoint)
+        lines += [f'# HELP {prefix}_request_sql_seconds_total Суммарное время SQL по маршрутам.',
+                  f'# TYPE {prefix}_request_sql_seconds_total counter']
+        lines += [f'{prefix}_request_sql_seconds_total{_labels(endpoint=e)} {v:.6f}' for e, v in sorted(metrics.sql_seconds.items())]
+        lines += [f'# HELP {prefix}_responses_total Ответы по маршрутам и кодам.',
+                  f'# TYPE {prefix}_responses_total counter']
+        lines += [f'{prefix}_responses_total{_labels(endpoint=e, method=m, status=s)} {v}'
+                  for (e, m, s), v in sorted(metrics.responses.items())]
+        lines += [f'# HELP {prefix}_slow_requests_total Запросы дольше порога SLOW_REQUEST_MS.',
+                  f'# TYPE {prefix}_slow_requests_total counter']
+        lines += [f'{prefix}_slow_requests_total{_labels(endpoint=e)} {v}' for e, v in sorted(metrics.slow.items())]
+        lines += [f'# HELP {prefix}_template_render_seconds_total Суммарное время рендера шаблонов.',
+                  f'# TYPE {prefix}_template_render_seconds_total counter']
+        lines += [f'{prefix}_template_render_seconds_total{_labels(template=t)} {v:.6f}'
+                  for t, v in sorted(metrics.template_seconds.items())]
+        lines += [f'# TYPE {prefix}_template_renders_total counter']
+        lines += [f'{prefix}_template_renders_total{_labels(template=t)} {v}' for t, v in sorted(metrics.template_renders.items())]
+    return '\n'.join(lines) + '\n'
+
+
+class StackSampler:
+    """Выборочный профайлер: раз в interval секунд запоминает стеки всех потоков, кроме своего."""
+
+    def __init__(self, interval, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                self.samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < self.max_depth:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self, limit=50):
+        # Свернутые стеки (формат flamegraph.pl / speedscope): "кадр;кадр;кадр число"
+        with self._lock:
+            return self.samples, self.stacks.most_common(limit)
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+
+def init_app(app, db):
+    """Подключает хуки к приложению и движку БД. Возвращает (RequestMetrics, StackSampler или None)."""
+    metrics = RequestMetrics()
+    slow_ms = app.config.get('SLOW_REQUEST_MS', 500)
+    server_timing = app.config.get('SERVER_TIMING_HEADER', False)
+
+    @app.before_request
+    def _start_request():
+        g._instr = {'started': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'templates': 0.0}
+
+    def _record(state, endpoint, method, path, status):
+        elapsed = time.perf_counter() - state['started']
+        slow = elapsed * 1000 >= slow_ms
+        metrics.observe_request(endpoint, method, status, elapsed, state['queries'], state['sql'], slow)
+        if slow:
+            app.logger.warning('Медленный запрос %s %s: %.0f мс, SQL %d шт. / %.0f мс, шаблоны %.0f мс',
+                               method, path, elapsed * 1000, state['queries'],
+                               state['sql'] * 1000, state['templates'] * 1000)
+        return elapsed
+
+    @app.after_request
+    def _finish_request(response):
+        endpoint = request.endpoint or 'unknown'
+        if '_instr' not in g or endpoint in EXCLUDED_ENDPOINTS:
+            g.pop('_instr', None)
+            return response
+        if response.is_streamed:
+            # Тело потокового ответа (stream_with_context) еще не сгенерировано: SQL внутри генератора
+            # попадает в тот же g._instr, итог считаем при закрытии ответа. Server-Timing уже не отправить
+            state, method, path, status = g._instr, request.method, request.path, response.status_code
+            response.call_on_close(lambda: _record(state, endpoint, method, path, status))
+            return response
+        state = g.pop('_instr')
+        elapsed = _record(state, endpoint, request.method, request.path, response.status_code)
+        if server_timing:
+            response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                                 f'db;dur={state["sql"] * 1000:.1f};desc="{state["queries"]} queries", '
+                                                 f'tpl;dur={state["templates"] * 1000:.1f}')
+        return response
+
+    with app.app_context():
+        engine = db.engine
+
+    # Время старта хранится в контексте выполнения самого запроса: after_cursor_execute не вызывается
+    # для упавшего запроса, и стек в conn.info пула соединений рос бы и путал пары старт/конец
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._instr_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_instr_started', None)
+        # Фоновые потоки (уведомления) работают вне запроса - их не учитываем
+        if started is not None and has_request_context() and '_instr' in g:
+            g._instr['queries'] += 1
+            g._instr['sql'] += time.perf_counter() - started
+
+    @before_render_template.connect_via(app)
+    def _before_render(sender, template, context, **extra):
+        if has_request_context():
+            g._template_started = time.perf_counter()
+
+    @template_rendered.connect_via(app)
+    def _after_render(sender, template, context, **extra):
+        if has_request_context() and '_template_started' in g:
+            elapsed = time.perf_counter() - g.pop('_template_started')
+            metrics.observe_template(template.name or 'string', elapsed)
+            if '_instr' in g:
+                g._instr['templates'] += elapsed
+
+    sampler = None
+    if app.config.get('PROFILER_INTERVAL_MS'):
+        sampler = StackSampler(app.config['PROFILER_INTERVAL_MS'] / 1000)
+        sampler.start()
+    return metrics, sampler